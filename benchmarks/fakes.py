@@ -0,0 +1,255 @@
+"""Local stand-ins for BrickLink, Rebrickable, S3 and the Bot API used by the replay harness.
+
+Every fake answers from generated catalog data, sleeps for a configurable latency and counts its calls, so a
+replayed update reports exactly which upstream calls it made.
+"""
+import asyncio
+import datetime
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+from botocore.exceptions import ClientError
+from telegram.request import BaseRequest
+
+SETS = [
+    ("75100-1", "First Order Snowspeeder", 2015),
+    ("75192-1", "Millennium Falcon", 2017),
+    ("10185-1", "Green Grocer", 2008),
+    ("10297-1", "Boutique Hotel", 2022),
+    ("4950-1", "The Loader-Dozer", 2000),
+    ("7140-1", "X-wing Fighter", 1999),
+]
+MINIFIGS = [
+    ("sw0547", "Darth Vader - Light Gray Head (Hollow Stud)", 2014),
+    ("sw0001a", "Battle Droid Tan with Back Plate", 1999),
+    ("col404", "Fishing Store Owner", 2021),
+    ("hp150", "Hermione Granger, Gryffindor Robe", 2018),
+]
+COUNTRIES = ["UA", "DE", "PL", "US", "UK", "CZ"]
+ITEM_PATH = re.compile(r"^/api/store/v1/items/(?P<type>[A-Z_]+)/(?P<no>[^/]+)(?:/(?P<resource>price|subsets|supersets))?$")
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(64)
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, service, operation):
+        with self.lock:
+            self.counts[service] += 1
+            self.counts[service + ":" + operation] += 1
+
+    def snapshot(self) -> Counter:
+        with self.lock:
+            return Counter(self.counts)
+
+
+def catalog_entry(item_type, number):
+    for catalog, entry_type in ((SETS, "SET"), (MINIFIGS, "MINIFIG")):
+        for no, name, year in catalog:
+            if no == number and entry_type == item_type:
+                return {"no": no, "name": name, "type": item_type, "category_id": 65, "year_released": year,
+                        "weight": "120.50", "image_url": "//img.bricklink.com/ItemImage/" + item_type[0] + "N/0/"
+                        + no + ".png", "thumbnail_url": "//img.bricklink.com/" + no + ".jpg", "is_obsolete": False}
+    return None
+
+
+def price_guide(item, params):
+    seed = int(hashlib.md5(item["no"].encode('utf-8')).hexdigest()[:6], 16)
+    details = [{"quantity": 1 + (seed + i) % 3, "unit_price": str(10 + (seed + i * 7) % 90) + ".5000",
+                "shipping_available": i % 2 == 0, "seller_country_code": COUNTRIES[i % len(COUNTRIES)],
+                "buyer_country_code": COUNTRIES[(i + 2) % len(COUNTRIES)],
+                "date_ordered": "2024-01-0" + str(1 + i % 9) + "T00:00:00.000Z"} for i in range(12)]
+    return {"item": {"no": item["no"], "type": item["type"]}, "new_or_used": params.get("new_or_used", "N"),
+            "currency_code": params.get("currency_code", "USD"), "min_price": "10.0000", "max_price": "99.5000",
+            "avg_price": "42.1250", "qty_avg_price": "40.0000", "unit_quantity": 12, "total_quantity": 20,
+            "price_detail": details}
+
+
+class FakeBrickLink:
+    def __init__(self, counter, latency):
+        self.counter = counter
+        self.latency = latency
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.latency)
+        if request.url.host == "img.bricklink.com":
+            self.counter.add("bricklink", "image")
+            return httpx.Response(200, content=PNG, headers={"Content-Type": "image/png"})
+        match = ITEM_PATH.match(request.url.path)
+        resource = match.group("resource") if match else None
+        self.counter.add("bricklink", resource or "item")
+        item = catalog_entry(match.group("type"), match.group("no")) if match else None
+        if item is None:
+            return httpx.Response(200, json={"meta": {"code": 404, "message": "RESOURCE_NOT_FOUND",
+                                                      "description": request.url.path}})
+        params = {key: values[0] for key, values in parse_qs(request.url.query.decode()).items()}
+        if resource == "price":
+            data = price_guide(item, params)
+        elif resource == "subsets":
+            data = [{"match_no": 0, "entries": [{"item": {"no": no, "name": name, "type": "MINIFIG"}, "quantity": 1,
+                                                 "extra_quantity": 0, "is_alternate": False}]}
+                    for no, name, year in MINIFIGS]
+        elif resource == "supersets":
+            data = [{"color_id": 0, "entries": [{"item": {"no": no, "name": name, "type": "SET"}, "quantity": 1,
+                                                 "appears_as": "R"} for no, name, year in SETS]}]
+        else:
+            data = item
+        return httpx.Response(200, json={"meta": {"code": 200, "message": "OK", "description": "OK"}, "data": data})
+
+
+class FakeRebrickable:
+    def __init__(self, counter, latency):
+        self.counter = counter
+        self.latency = latency
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(self.latency)
+        self.counter.add("rebrickable", "sets")
+        query = parse_qs(request.url.query.decode()).get("search", [""])[0].lower()
+        results = [{"set_num": no, "name": name, "year": year, "theme_id": 158, "num_parts": 500,
+                    "set_img_url": "https://cdn.rebrickable.com/media/sets/" + no + ".jpg"}
+                   for no, name, year in SETS if all(word in name.lower() for word in query.split())]
+        return httpx.Response(200, json={"count": len(results), "next": None, "previous": None, "results": results})
+
+
+class StreamingBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            chunk = self.stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeS3:
+    def __init__(self, counter, latency):
+        self.counter = counter
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def call(self, operation):
+        self.counter.add("s3", operation)
+        time.sleep(self.latency)
+
+    def store(self, key, body, metadata=None):
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        with self.lock:
+            self.objects[key] = (body, etag, metadata or {}, datetime.datetime.now(datetime.timezone.utc))
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfModifiedSince=None, **kwargs):
+        self.call("get_object")
+        with self.lock:
+            entry = self.objects.get(Key)
+        if entry is None:
+            raise client_error("NoSuchKey", "GetObject")
+        body, etag, metadata, modified = entry
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise client_error("304", "GetObject")
+        if IfModifiedSince is not None and modified <= IfModifiedSince:
+            raise client_error("304", "GetObject")
+        return {"Body": StreamingBody(body), "ETag": etag, "Metadata": dict(metadata), "LastModified": modified,
+                "ContentLength": len(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        self.call("put_object")
+        with self.lock:
+            entry = self.objects.get(Key)
+        if IfNoneMatch == "*" and entry is not None or IfMatch is not None and (entry is None or entry[1] != IfMatch):
+            raise client_error("PreconditionFailed", "PutObject")
+        self.store(Key, Body if isinstance(Body, bytes) else Body.read(), Metadata)
+        return {"ETag": self.objects[Key][1]}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.call("upload_fileobj")
+        self.store(Key, Fileobj.read())
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.call("upload_file")
+        with open(Filename, 'rb') as file:
+            self.store(Key, file.read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.call("delete_object")
+        with self.lock:
+            self.objects.pop(Key, None)
+        return {}
+
+
+class FakeBotApi(BaseRequest):
+    def __init__(self, counter, latency, bot_name="benchmark_bot"):
+        self.counter = counter
+        self.latency = latency
+        self.bot_name = bot_name
+        self.message_id = 0
+        # chats every send to fails, as if the Bot API were down for them
+        self.failing_chats = set()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def message(self, endpoint, parameters) -> dict:
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()),
+                   "chat": {"id": int(parameters.get("chat_id", 1)), "type": "private"}}
+        if "text" in parameters:
+            message["text"] = parameters["text"]
+        # uploaded files travel as multipart data and are missing from the parameters
+        if endpoint == "sendPhoto":
+            message["photo"] = [{"file_id": "photo-" + str(self.message_id), "file_unique_id": "u" + str(self.message_id),
+                                 "width": 320, "height": 240}]
+        if endpoint == "sendDocument":
+            message["document"] = {"file_id": "doc-" + str(self.message_id), "file_unique_id": "d" + str(self.message_id)}
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        if endpoint != "getMe":
+            self.counter.add("telegram", endpoint)
+            await asyncio.sleep(self.latency)
+        if endpoint.startswith("send") and parameters.get("chat_id") in self.failing_chats:
+            return 502, json.dumps({"ok": False, "error_code": 502, "description": "Bad Gateway"}).encode("utf-8")
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": self.bot_name}
+        elif endpoint in ("answerCallbackQuery", "sendChatAction", "setWebhook", "deleteWebhook"):
+            result = True
+        elif endpoint == "getFile":
+            result = {"file_id": parameters.get("file_id", "file"), "file_unique_id": "f", "file_size": 0,
+                      "file_path": "documents/file.xml"}
+        else:
+            result = self.message(endpoint, parameters)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
@@ -0,0 +1,116 @@
+"""Import-time profile of the bot's Lambda entry point, built on python -X importtime.
+
+Imports the module in fresh interpreters and reports the median cumulative import time, its direct imports and
+the modules that cost the most. --check fails when a module that is meant to load lazily (boto3, the XML parser,
+sqlite3, ...) is imported on cold start again, or when the total exceeds --max-ms.
+
+    python benchmarks/importtime.py [--module app] [--runs 5] [--top 15] [--check] [--max-ms N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.join(HERE, '..', 'bricklink_telegram_bot')
+ENVIRONMENT = {
+    'TELEGRAM_BOT_TOKEN': '123456:importtime',
+    'ADMIN_USERS': '@importtime_admin',
+    'BL_CONSUMER_KEY': 'importtime',
+    'BL_CONSUMER_SECRET': 'importtime',
+    'BL_ACCESS_TOKEN': 'importtime',
+    'BL_TOKEN_SECRET': 'importtime',
+    'AWS_REGION': 'eu-central-1',
+    'BUCKET': 'importtime-bucket',
+    'MF_FILE': 'minifigs.csv',
+    'REBRICKABLE_KEY': 'importtime',
+    'BOT_NAME': 'importtime_bot',
+    'LOGLEVEL': 'WARNING'
+}
+# loaded by the first update that needs them, never by importing the entry point
+DEFERRED_MODULES = ('boto3', 's3transfer', 'botocore.session', 'botocore.client', 'xml.etree.ElementTree', 'sqlite3')
+
+
+class Node:
+    def __init__(self, name, depth, self_us, cumulative_us):
+        self.name = name
+        self.depth = depth
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.children = []
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def parse(output) -> list:
+    # -X importtime prints a module after everything it imported, indented two spaces per level
+    roots = []
+    pending = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        node = Node(name.strip(), depth, int(self_us), int(cumulative_us))
+        node.children = pending.pop(depth + 1, [])
+        pending.setdefault(depth, []).append(node)
+    for depth in sorted(pending):
+        roots.extend(pending[depth])
+    return roots
+
+
+def profile(module) -> Node:
+    environment = dict(ENVIRONMENT, **os.environ)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=BOT_DIR,
+                            env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+    for root in parse(result.stderr):
+        if root.name == module:
+            return root
+    raise Exception(module + " not found in -X importtime output")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help="most expensive modules to list")
+    parser.add_argument('--check', action='store_true', help="fail when a deferred module is imported eagerly")
+    parser.add_argument('--max-ms', type=float, help="with --check, also fail above this median total")
+    arguments = parser.parse_args()
+
+    runs = [profile(arguments.module) for _ in range(max(arguments.runs, 1))]
+    total_ms = statistics.median(run.cumulative_us for run in runs) / 1000
+    # the run closest to the median stands in for the breakdown
+    sample = min(runs, key=lambda run: abs(run.cumulative_us / 1000 - total_ms))
+    print("import " + arguments.module + ": {:.1f} ms median of {} runs".format(total_ms, len(runs)))
+    print()
+    print("{:<48}{:>12}".format("direct import", "cumul. ms"))
+    for child in sorted(sample.children, key=lambda node: -node.cumulative_us):
+        print("{:<48}{:>12.1f}".format(child.name, child.cumulative_us / 1000))
+    print()
+    print("{:<48}{:>12}".format("module", "self ms"))
+    for node in sorted(sample.walk(), key=lambda node: -node.self_us)[:arguments.top]:
+        print("{:<48}{:>12.1f}".format(node.name, node.self_us / 1000))
+
+    if arguments.check:
+        imported = {node.name for run in runs for node in run.walk()}
+        failures = ["imports " + name + " on cold start" for name in DEFERRED_MODULES if name in imported]
+        if arguments.max_ms is not None and total_ms > arguments.max_ms:
+            failures.append("takes {:.1f} ms, budget {:.1f} ms".format(total_ms, arguments.max_ms))
+        print()
+        for failure in failures:
+            print("FAILED import " + arguments.module + " " + failure)
+        if failures:
+            sys.exit(1)
+        print("No deferred module is imported by " + arguments.module)
+
+
+if __name__ == '__main__':
+    main()
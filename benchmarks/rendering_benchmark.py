@@ -0,0 +1,218 @@
+"""Microbenchmark and equivalence check for the reply rendering in bricklink_telegram_bot.
+
+Compares the current formatters and escaping against the implementation they replaced, which is kept below
+verbatim. Exits with a non-zero status if any output differs.
+
+    python benchmarks/rendering_benchmark.py [--number N]
+"""
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bricklink_telegram_bot'))
+# response_formatters pulls in the API clients, which read their settings at import time; nothing is called here
+for name in ('BL_CONSUMER_KEY', 'BL_CONSUMER_SECRET', 'BL_ACCESS_TOKEN', 'BL_TOKEN_SECRET', 'BUCKET', 'MF_FILE'):
+    os.environ.setdefault(name, 'benchmark')
+os.environ.setdefault('AWS_REGION', 'eu-central-1')
+os.environ.setdefault('QUOTA_STORE_ENABLED', 'false')
+
+import rendering  # noqa: E402
+import response_formatters  # noqa: E402
+from response_formatters import format_price, get_currency_symbol, resolve_availability_section  # noqa: E402
+
+ASCII_LOWER = "abcdefghijklmnopqrstuvwxyz0123456789"
+OFFSET = ord("🇦") - ord("A")
+
+
+def resolve_flag_emoji(countrycode: str) -> str:
+    if countrycode == "UK":
+        return u"\U0001F1EC\U0001F1E7"
+    elif countrycode == "RU":
+        return u"\U0001F4A9"
+    code = [c for c in countrycode.lower() if c in ASCII_LOWER]
+    return "".join([chr(ord(c.upper()) + OFFSET) for c in code])
+
+
+def legacy_unescape_html(s: str) -> str:
+    s = s.replace("&#40;", "(")
+    s = s.replace("&#41;", ")")
+    s = s.replace("&lt;", "<")
+    s = s.replace("&gt;", ">")
+    s = s.replace("&#39;", "'")
+    s = s.replace("&amp;", "&")
+    return s
+
+
+def legacy_escape(s: str) -> str:
+    s = s.replace("-", "\\-")
+    s = s.replace("!", "\\!")
+    s = s.replace("[", "\\[")
+    s = s.replace("]", "\\]")
+    s = s.replace("(", "\\(")
+    s = s.replace(")", "\\)")
+    s = s.replace("{", "\\{")
+    s = s.replace("}", "\\}")
+    s = s.replace(".", "\\.")
+    s = s.replace("_", "\\_")
+    s = s.replace("*", "\\*")
+    s = s.replace("`", "\\`")
+    s = s.replace("&", "\\&")
+    s = s.replace("<", "\\<")
+    s = s.replace(">", "\\>")
+    s = s.replace("#", "\\#")
+    s = s.replace("=", "\\=")
+    return s
+
+
+def legacy_format_info_response(message_dict: dict, available) -> str:
+    logging.debug("[Response formatter] format info response for: " + str(message_dict))
+    raw = (u"\U0001F170\uFE0F Name: " + legacy_unescape_html(message_dict["name"]) + "\n"
+           "\U0001F5BC Image: " + message_dict["image_url"] + "\n"
+           "\U0001F4C6 Year released: " + str(message_dict["year_released"]) + "\n"
+           "\u2693\uFE0F Weight: " + str(message_dict["weight"]) + "g\n")
+    return legacy_escape(raw) + resolve_availability_section(message_dict, available)
+
+
+def legacy_format_price_response(message: dict) -> str:
+    res = (u"Price for " + message["item"]["no"] + " (" + message["new_or_used"] + ")" + "\n" +
+           "\U0001F4C9 Minimal price: " + format_price(message["min_price"]) +
+           get_currency_symbol(message["currency_code"]) + "\n" +
+           u"\U0001F4C8 Maximal price: " + format_price(message["max_price"]) +
+           get_currency_symbol(message["currency_code"]) + "\n" +
+           "\U0001F4CA Median price: " + format_price(message["avg_price"]) +
+           get_currency_symbol(message["currency_code"]) + "\n" +
+           "\U0001F522 Quantity for sale: " + str(message["total_quantity"]))
+    return legacy_escape(res)
+
+
+def legacy_format_items_sold_response(message: dict) -> str:
+    if len(message["price_detail"]) > 0:
+        res = u"Recently sold " + message["item"]["no"] + " (" + message["new_or_used"] + "):"
+        for item in itertools.islice(message["price_detail"], 20):
+            res += "\nSeller: " + resolve_flag_emoji(item["seller_country_code"]) + \
+                   ", Buyer: " + resolve_flag_emoji(item["buyer_country_code"]) + \
+                   ", Price: " + format_price(item["unit_price"]) + " " + get_currency_symbol(message["currency_code"]) + \
+                   ", Quantity: " + str(item["quantity"])
+    else:
+        res = "Seems like no " + message["item"]["no"] + " were sold recently \U0001F914"
+    return legacy_escape(res)
+
+
+def legacy_format_items_for_sale_response(message: dict) -> str:
+    if len(message["price_detail"]) > 0:
+        res = message["item"]["no"] + " for sale (" + message["new_or_used"] + "):"
+        for item in itertools.islice(message["price_detail"], 20):
+            res += u"\n\U0001F4B5 Price: " + format_price(item["unit_price"]) + get_currency_symbol(
+                message["currency_code"]) + \
+                   ", \U0001F522 Quantity: " + str(item["quantity"]) + \
+                   ", \U0001F69A Ships to " + resolve_flag_emoji("ua") + ": " + \
+                   (u"\u2705" if item["shipping_available"] else u"\u274C")
+    else:
+        res = "Seems like " + message["item"]["no"] + " is out of stock \U0001F914"
+    return legacy_escape(res)
+
+
+NAMES = [
+    "Millennium Falcon",
+    "Darth Vader - Light Gray Head (Hollow Stud) &#40;2015&#41;",
+    "Hotel &amp; Caf&#39;e &lt;Modular&gt; [Limited] {Edition} #1 = 5*2_`x`!",
+    "&amp;lt; double escaped &amp;amp;",
+    "Minifig, Utensil Cup / Mug",
+]
+
+
+def info_message(name, index) -> dict:
+    return {"no": str(75100 + index) + "-1", "name": name, "type": "SET" if index % 2 else "MINIFIG",
+            "image_url": "//img.bricklink.com/ItemImage/SN/0/" + str(75100 + index) + "-1.png",
+            "year_released": 2010 + index, "weight": str(100.5 + index)}
+
+
+def price_message(index, currency) -> dict:
+    return {"item": {"no": "sw0" + str(500 + index)}, "new_or_used": "N" if index % 2 else "U",
+            "min_price": "1.2345", "max_price": str(300.5 + index), "avg_price": "20.0000",
+            "total_quantity": 12 + index, "currency_code": currency}
+
+
+def detail_message(count, currency) -> dict:
+    countries = ["UA", "UK", "DE", "US", "RU", "PL"]
+    return {"item": {"no": "75100-1"}, "new_or_used": "U", "currency_code": currency,
+            "price_detail": [{"seller_country_code": countries[i % 6], "buyer_country_code": countries[(i + 1) % 6],
+                              "unit_price": str(10 + i * 1.37), "quantity": i + 1,
+                              "shipping_available": i % 3 == 0} for i in range(count)]}
+
+
+def cases():
+    for index, name in enumerate(NAMES):
+        for available in (None, True, False):
+            message = info_message(name, index)
+            yield "info", legacy_format_info_response, response_formatters.format_info_response, (message, available)
+    for index, currency in enumerate(("EUR", "UAH", "USD", "GBP")):
+        message = price_message(index, currency)
+        yield "price", legacy_format_price_response, response_formatters.format_price_response, (message,)
+    for count in (0, 1, 20, 35):
+        message = detail_message(count, "EUR")
+        yield "sold", legacy_format_items_sold_response, response_formatters.format_items_sold_response, (message,)
+        yield "stock", legacy_format_items_for_sale_response, response_formatters.format_items_for_sale_response, \
+            (message,)
+
+
+def random_strings(count, seed=7):
+    alphabet = rendering.MARKDOWN_SPECIAL + "abc XYZ019\\\n+|~;'\"" + "".join(entity for entity, char in rendering.HTML_ENTITIES)
+    generator = random.Random(seed)
+    return ["".join(generator.choice(alphabet) for _ in range(generator.randint(0, 80))) for _ in range(count)]
+
+
+def check_equivalence() -> int:
+    failures = 0
+    for kind, legacy, current, args in cases():
+        if legacy(*args) != current(*args):
+            failures += 1
+            print("MISMATCH " + kind + ": " + repr(args)[:120])
+    for code in ("UA", "UK", "RU", "de", "us", "", "X1"):
+        if resolve_flag_emoji(code) != response_formatters.resolve_flag_emoji(code):
+            failures += 1
+            print("MISMATCH resolve_flag_emoji: " + repr(code))
+    for text in random_strings(2000) + NAMES:
+        if legacy_escape(text) != rendering.escape(text):
+            failures += 1
+            print("MISMATCH escape: " + repr(text))
+        if legacy_unescape_html(text) != rendering.unescape_html(text):
+            failures += 1
+            print("MISMATCH unescape_html: " + repr(text))
+    return failures
+
+
+def benchmark(number):
+    text = " ".join(NAMES) * 4
+    pairs = [("escape", legacy_escape, rendering.escape, (text,)),
+             ("unescape_html", legacy_unescape_html, rendering.unescape_html, (text,))]
+    seen = set()
+    for kind, legacy, current, args in cases():
+        if kind not in seen or kind in ("sold", "stock") and args[0]["price_detail"]:
+            seen.add(kind)
+            pairs.append((kind, legacy, current, args))
+    print("{:<16}{:>14}{:>14}{:>10}".format("case", "legacy us", "current us", "speedup"))
+    for kind, legacy, current, args in pairs:
+        before = min(timeit.repeat(lambda: legacy(*args), number=number, repeat=5)) / number * 1e6
+        after = min(timeit.repeat(lambda: current(*args), number=number, repeat=5)) / number * 1e6
+        print("{:<16}{:>14.2f}{:>14.2f}{:>9.2f}x".format(kind, before, after, before / after))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help="calls per timing run")
+    arguments = parser.parse_args()
+    failures = check_equivalence()
+    if failures:
+        print(str(failures) + " outputs differ from the previous implementation")
+        sys.exit(1)
+    print("All outputs match the previous implementation")
+    benchmark(arguments.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""Replay recorded Telegram updates through app.lambda_handler against local fakes.
+
+BrickLink, Rebrickable, S3 and the Bot API are replaced by the fakes in fakes.py, each with its own latency. For
+every scenario the first update runs against a cold container (empty caches, no catalog loaded) and the rest run
+warm. The report shows end-to-end latency percentiles, the Python heap peak and the exact outbound calls per update;
+a reply returned in the webhook response is not an outbound call.
+A scenario with a list of "updates" instead is delivered as one SQS batch event and measured per invocation. Its
+"fail_chats" make every send to those chats fail, and then exactly the messages listed in "failures" have to be
+reported back to the queue. A "silent" scenario fails when its update gets any reply at all.
+
+    python benchmarks/replay.py                  # report only
+    python benchmarks/replay.py --check          # exit 1 when a scenario exceeds benchmarks/budget.json
+    python benchmarks/replay.py --write-budget   # record the current numbers as the new budget
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'bricklink_telegram_bot'))
+sys.path.insert(0, HERE)
+# Settings the bot reads at import time; the fakes never look at the credentials
+ENVIRONMENT = {
+    'TELEGRAM_BOT_TOKEN': '123456:replay',
+    'ADMIN_USERS': '@replay_admin',
+    'BL_CONSUMER_KEY': 'replay',
+    'BL_CONSUMER_SECRET': 'replay',
+    'BL_ACCESS_TOKEN': 'replay',
+    'BL_TOKEN_SECRET': 'replay',
+    'AWS_REGION': 'eu-central-1',
+    'BUCKET': 'replay-bucket',
+    'MF_FILE': 'minifigs.csv',
+    'REBRICKABLE_KEY': 'replay',
+    'BOT_NAME': 'replay_bot',
+    'LOGLEVEL': 'WARNING',
+    'SETS_DB_PATH': os.path.join(tempfile.gettempdir(), 'replay-sets.sqlite')
+}
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+import httpx  # noqa: E402
+
+import app  # noqa: E402
+import dedup  # noqa: E402
+import handlers  # noqa: E402
+import quota  # noqa: E402
+import rebrickable_client  # noqa: E402
+import request_matcher  # noqa: E402
+import s3_client  # noqa: E402
+import set_catalog  # noqa: E402
+from fakes import CallCounter, FakeBrickLink, FakeRebrickable, FakeS3, FakeBotApi, SETS, MINIFIGS  # noqa: E402
+
+SERVICES = ('bricklink', 'rebrickable', 's3', 'telegram')
+DEFAULT_LATENCY_MS = {'bricklink': 80, 'rebrickable': 120, 's3': 15, 'telegram': 50}
+DEFAULT_SCENARIOS = os.path.join(HERE, 'scenarios.json')
+DEFAULT_BUDGET = os.path.join(HERE, 'budget.json')
+LATENCY_HEADROOM = 1.5
+LATENCY_SLACK_MS = 5.0
+MEMORY_HEADROOM = 1.3
+
+
+class Harness:
+    def __init__(self, latency_ms):
+        self.counter = CallCounter()
+        self.bricklink = FakeBrickLink(self.counter, latency_ms['bricklink'] / 1000)
+        self.rebrickable = FakeRebrickable(self.counter, latency_ms['rebrickable'] / 1000)
+        self.s3 = FakeS3(self.counter, latency_ms['s3'] / 1000)
+        self.bot_api = FakeBotApi(self.counter, latency_ms['telegram'] / 1000, os.environ['BOT_NAME'])
+        self.update_id = 0
+        self.seeded = {}
+
+    def install(self):
+        s3_client.s3 = self.s3
+        request_matcher.client.session = httpx.AsyncClient(transport=self.bricklink.transport())
+        rebrickable_client.client.session = httpx.AsyncClient(base_url=rebrickable_client.BASE_URL,
+                                                              transport=self.rebrickable.transport())
+        dispatcher = app.build_application(request=self.bot_api)
+        app.get_event_loop().run_until_complete(dispatcher.initialize())
+        app.application = dispatcher
+        self.seed()
+
+    def seed(self):
+        s3_client.write_minifigs_to_file(MINIFIGS)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sets.sqlite')
+            set_catalog.build_database([(no, name, year, 158, 500, None) for no, name, year in SETS], path)
+            with open(path, 'rb') as file:
+                self.s3.store(set_catalog.SETS_DB_FILE, file.read())
+        self.seeded = dict(self.s3.objects)
+
+    def cold_start(self):
+        # what a fresh Lambda container starts with, against a bucket holding only the published catalogs, so
+        # a scenario's numbers do not depend on the ones replayed before it
+        self.s3.objects = dict(self.seeded)
+        request_matcher.cache.local.clear()
+        rebrickable_client.cache.local.clear()
+        handlers.photo_cache.local.clear()
+        s3_client.minifigure_index = None
+        s3_client.minifigure_etag = None
+        s3_client.minifigure_checked_at = 0.0
+        if set_catalog.connection is not None:
+            set_catalog.connection.close()
+        set_catalog.connection = None
+        set_catalog.connection_etag = None
+        set_catalog.connection_checked_at = 0.0
+        quota.governor.__init__(store=quota.governor.store)
+        if dedup.deduplicator is not None:
+            dedup.deduplicator.seen.clear()
+
+    def next_update(self, update) -> dict:
+        self.update_id += 1
+        update = copy.deepcopy(update)
+        update['update_id'] = self.update_id
+        return update
+
+    def event(self, scenario) -> dict:
+        if scenario.get('redelivered'):
+            # Telegram retrying one update: every iteration carries the same update_id
+            return {'body': json.dumps(scenario['update'])}
+        if 'updates' not in scenario:
+            return {'body': json.dumps(self.next_update(scenario['update']))}
+        # a batch is delivered the way an SQS event source would deliver it
+        return {'Records': [{'messageId': 'message-' + str(index), 'eventSource': 'aws:sqs',
+                             'body': json.dumps(self.next_update(update))}
+                            for index, update in enumerate(scenario['updates'])]}
+
+    def replay(self, scenario) -> tuple:
+        event = self.event(scenario)
+        before = self.counter.snapshot()
+        self.bot_api.failing_chats = set(scenario.get('fail_chats', ()))
+        started = time.perf_counter()
+        response = app.lambda_handler(event, None)
+        elapsed = (time.perf_counter() - started) * 1000
+        self.bot_api.failing_chats = set()
+        calls = self.counter.snapshot()
+        calls.subtract(before)
+        if 'body' in response:
+            # Telegram makes this call itself once it has the response
+            self.counter.add('webhook_reply', json.loads(response['body'])['method'])
+        if scenario.get('silent') and ('body' in response or calls['telegram']):
+            return 500, elapsed, calls
+        if 'batchItemFailures' in response:
+            failures = sorted(failure['itemIdentifier'] for failure in response['batchItemFailures'])
+            return 200 if failures == sorted(scenario.get('failures', ())) else 500, elapsed, calls
+        return response['statusCode'], elapsed, calls
+
+    def run(self, scenario, iterations) -> dict:
+        self.cold_start()
+        latencies = []
+        warm_calls = {service: 0 for service in SERVICES}
+        cold_calls = None
+        cold_ms = None
+        errors = 0
+        for iteration in range(iterations):
+            status, elapsed, calls = self.replay(scenario)
+            errors += status != 200
+            if iteration == 0:
+                cold_ms = elapsed
+                cold_calls = {service: calls[service] for service in SERVICES}
+                continue
+            latencies.append(elapsed)
+            for service in SERVICES:
+                warm_calls[service] += calls[service]
+        self.cold_start()
+        tracemalloc.start()
+        self.replay(scenario)
+        self.replay(scenario)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        warm = max(len(latencies), 1)
+        return {
+            'name': scenario['name'],
+            'errors': errors,
+            'cold_ms': round(cold_ms, 1),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'mean_ms': round(statistics.fmean(latencies), 1) if latencies else 0.0,
+            'peak_kib': round(peak / 1024),
+            'cold_calls': cold_calls,
+            'warm_calls': {service: round(count / warm, 2) for service, count in warm_calls.items()}
+        }
+
+
+def percentile(values, rank) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(rank / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def format_calls(calls) -> str:
+    return "/".join(("{:g}".format(calls[service])) for service in SERVICES)
+
+
+def print_report(results):
+    print("calls are bricklink/rebrickable/s3/telegram per update")
+    print("{:<22}{:>9}{:>8}{:>8}{:>8}{:>9}  {:<14}{:<18}".format(
+        "scenario", "cold ms", "p50", "p95", "p99", "peak KiB", "cold calls", "warm calls"))
+    for result in results:
+        print("{:<22}{:>9.1f}{:>8.1f}{:>8.1f}{:>8.1f}{:>9}  {:<14}{:<18}{}".format(
+            result['name'], result['cold_ms'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['peak_kib'], format_calls(result['cold_calls']), format_calls(result['warm_calls']),
+            "  ERRORS: " + str(result['errors']) if result['errors'] else ""))
+
+
+def check_budget(results, budget) -> list:
+    failures = []
+    for result in results:
+        limits = budget['scenarios'].get(result['name'])
+        if limits is None:
+            failures.append(result['name'] + ": no budget recorded")
+            continue
+        if result['errors']:
+            failures.append(result['name'] + ": " + str(result['errors']) + " updates failed")
+        for phase in ('cold_calls', 'warm_calls'):
+            for service in SERVICES:
+                if result[phase][service] > limits[phase].get(service, 0) + 1e-9:
+                    failures.append(result['name'] + ": " + str(result[phase][service]) + " " + service + " " +
+                                    phase.replace('_', ' ') + ", budget " + str(limits[phase].get(service, 0)))
+        for metric in ('p95_ms', 'peak_kib'):
+            if result[metric] > limits[metric]:
+                failures.append(result['name'] + ": " + metric + " " + str(result[metric]) + ", budget " +
+                                str(limits[metric]))
+    return failures
+
+
+def budget_for(results, latency_ms) -> dict:
+    return {
+        'latency_ms': latency_ms,
+        'scenarios': {result['name']: {
+            'cold_calls': result['cold_calls'],
+            'warm_calls': result['warm_calls'],
+            'p95_ms': round(result['p95_ms'] * LATENCY_HEADROOM + LATENCY_SLACK_MS, 1),
+            'peak_kib': round(result['peak_kib'] * MEMORY_HEADROOM)
+        } for result in results}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=DEFAULT_SCENARIOS, help="JSON list of {name, update} or {name, updates}")
+    parser.add_argument('--budget', default=DEFAULT_BUDGET)
+    parser.add_argument('--iterations', type=int, default=20, help="updates replayed per scenario, first one cold")
+    parser.add_argument('--only', action='append', help="run only the named scenario, can be repeated")
+    parser.add_argument('--check', action='store_true', help="fail when a scenario exceeds the budget")
+    parser.add_argument('--write-budget', action='store_true', help="record the current numbers as the budget")
+    for service in SERVICES:
+        parser.add_argument('--' + service + '-ms', type=float, dest=service, help="fake " + service + " latency")
+    arguments = parser.parse_args()
+
+    budget = None
+    if os.path.exists(arguments.budget):
+        with open(arguments.budget) as file:
+            budget = json.load(file)
+    # latencies recorded with the budget keep runs comparable unless overridden on the command line
+    latency_ms = dict(DEFAULT_LATENCY_MS, **(budget or {}).get('latency_ms', {}))
+    latency_ms.update({service: getattr(arguments, service) for service in SERVICES
+                       if getattr(arguments, service) is not None})
+    with open(arguments.scenarios) as file:
+        scenarios = [scenario for scenario in json.load(file)
+                     if not arguments.only or scenario['name'] in arguments.only]
+
+    harness = Harness(latency_ms)
+    harness.install()
+    results = [harness.run(scenario, max(arguments.iterations, 2)) for scenario in scenarios]
+    print_report(results)
+
+    if arguments.write_budget:
+        written = budget_for(results, latency_ms)
+        if budget is not None and arguments.only:
+            # --only refreshes the named scenarios and keeps the rest of the budget
+            written['scenarios'] = dict(budget['scenarios'], **written['scenarios'])
+        with open(arguments.budget, 'w') as file:
+            json.dump(written, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print("Budget written to " + arguments.budget)
+    if arguments.check:
+        if budget is None:
+            print("No budget at " + arguments.budget)
+            sys.exit(1)
+        failures = check_budget(results, budget)
+        for failure in failures:
+            print("OVER BUDGET " + failure)
+        if failures:
+            sys.exit(1)
+        print("All scenarios within budget")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,100 @@
 import asyncio
+import atexit
 import json
 import os
 import logging
+import time
+from contextvars import ContextVar
 
+import httpx
 from telegram import Update
+from telegram.error import NetworkError
 from telegram.ext import MessageHandler, CommandHandler, filters, Application, CallbackQueryHandler
+from telegram.request import HTTPXRequest
 
-from handlers import start_handler, price_command_handler, help_handler, group_button_handler, price_button_handler, \
-    def_button_handler, sold_button_handler, stock_button_handler, info_command_handler, info_message_handler, set_search_handler, \
-    info_button_handler, minifigure_search_handler, search_set_button_handler, subset_button_handler, superset_button_handler, \
-    file_message_handler
+from handlers import start_handler, price_command_handler, help_handler, info_command_handler, info_message_handler, \
+    set_search_handler, minifigure_search_handler, file_message_handler, callback_router
+from request_matcher import client, cache
+from cache import flush_shared_tier, pending_writes
+from dedup import deduplicator
+from quota import governor
+import rebrickable_client
+import tracing
+import webhook_reply
+from valuation import load_job, advance_job, VALUATION_SAFETY_MARGIN
 
 TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
 LOGLEVEL = os.environ.get('LOGLEVEL', 'DEBUG')
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '10'))
 logging.getLogger().setLevel(level=LOGLEVEL.upper())
 
+# Process-lifetime state: Lambda reuses the container between invocations, so the application,
+# its Bot API connection pool and the event loop they are bound to are kept warm here.
+loop = None
+application = None
+# PTB hands exceptions raised by handlers to the error handlers instead of raising them from process_update, so the
+# ones of the update being processed are collected here
+handler_errors = ContextVar('handler_errors', default=None)
+
 
 def lambda_handler(event, context):
+    if "Records" in event:
+        return batch_handler(event, context)
+    try:
+        reply = get_event_loop().run_until_complete(run_handler(event))
+    except Exception as e:
+        logging.error(e)
+        return {"statusCode": 500}
+    if reply is None:
+        return {"statusCode": 200}
+    # the update's last Bot API call, made by Telegram on receiving this response
+    return {"statusCode": 200, "headers": {"Content-Type": "application/json"}, "body": json.dumps(reply)}
+
+
+def batch_handler(event, context):
+    # Queue event source (SQS): every record carries one update. Failed records are reported back, so the queue
+    # retries only those instead of the whole batch.
+    records = event["Records"]
+    try:
+        failures = get_event_loop().run_until_complete(run_batch(records))
+    except Exception as e:
+        logging.error(e)
+        failures = [record["messageId"] for record in records]
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failures]}
+
+
+def valuation_handler(event, context):
+    # Worker entry point: prices a saved valuation job for as long as this invocation may run
     try:
-        asyncio.get_event_loop().run_until_complete(run_handler(event))
+        get_event_loop().run_until_complete(run_valuation(event, context))
         return {"statusCode": 200}
     except Exception as e:
         logging.error(e)
         return {"statusCode": 500}
 
 
-async def run_handler(event):
-    logging.debug("[App] Calling lambda")
-    dispatcher = Application.builder().token(token=TOKEN).build()
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    global loop
+    if loop is None or loop.is_closed():
+        logging.debug("[App] Creating event loop")
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    return loop
+
+
+def build_application(request=None) -> Application:
+    logging.debug("[App] Building application")
+    if request is None:
+        request = tracing.TracedRequest(connection_pool_size=256) if tracing.TRACING_ENABLED \
+            else HTTPXRequest(connection_pool_size=256)
+    if webhook_reply.WEBHOOK_REPLY_ENABLED:
+        request = webhook_reply.WebhookReplyRequest(request)
+    dispatcher = Application.builder().token(token=TOKEN).updater(None).request(request).build()
+    register_handlers(dispatcher)
+    return dispatcher
+
+
+def register_handlers(dispatcher: Application):
     logging.debug("[App] Adding command handlers")
     dispatcher.add_handler(CommandHandler(command='start', callback=start_handler))
     dispatcher.add_handler(CommandHandler(command='price', callback=price_command_handler))
@@ -40,21 +107,175 @@ async def run_handler(event):
                                                   filters.Document.TEXT) & (~filters.COMMAND),
                                           callback=file_message_handler))
     dispatcher.add_handler(MessageHandler(filters=filters.TEXT & (~filters.COMMAND), callback=info_message_handler))
-    dispatcher.add_handler(CallbackQueryHandler(group_button_handler, pattern="^.*more.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(price_button_handler, pattern="^.*PRICE.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(sold_button_handler, pattern="^.*SOLD.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(stock_button_handler, pattern="^.*STOCK.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(info_button_handler, pattern="^.*INFO.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(search_set_button_handler, pattern="^.*SETSEARCH.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(minifigure_search_handler, pattern="^.*MINIFIGSEARCH.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(subset_button_handler, pattern="^.*SUBSET.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(superset_button_handler, pattern="^.*SUPERSET.*$"))
-    dispatcher.add_handler(CallbackQueryHandler(def_button_handler))
-    await dispatcher.initialize()
-    logging.debug("[App] Application initialized")
-    await dispatcher.process_update(update=Update.de_json(json.loads(event["body"]), dispatcher.bot))
+    dispatcher.add_handler(CallbackQueryHandler(callback_router))
+    dispatcher.add_error_handler(record_error)
+
+
+async def record_error(update, context):
+    logging.error("[App] Handler failed")
+    logging.error(context.error)
+    errors = handler_errors.get()
+    if errors is not None:
+        errors.append(context.error)
+
+
+async def get_application() -> Application:
+    global application
+    if application is None:
+        dispatcher = build_application()
+        await dispatcher.initialize()
+        logging.debug("[App] Application initialized")
+        application = dispatcher
+    return application
+
+
+async def run_handler(event) -> dict:
+    logging.debug("[App] Calling lambda")
+    dispatcher = await get_application()
     logging.debug("[App] Event: ")
     logging.debug(event["body"])
-    logging.debug("Shutting down application")
+    body = json.loads(event["body"])
+    kind = next((key for key in body if key != "update_id"), "update")
+    with tracing.trace(body.get("update_id"), kind), webhook_reply.collect() as reply:
+        update = Update.de_json(body, dispatcher.bot)
+        # a failed update is released for Telegram's retry, which makes a reply held back here once more
+        await run_once(update.update_id, respond(dispatcher, update, reply))
+        await flush()
+    logging.debug("[App] BrickLink cache stats: " + str(cache.stats()))
+    return reply.body()
+
+
+def transient(error) -> bool:
+    # Telegram or BrickLink could not be reached: a retry of the update may get through, while a retry of a
+    # handler bug only fails again
+    return isinstance(error, (NetworkError, httpx.TransportError))
+
+
+def every_error(error) -> bool:
+    return True
+
+
+async def process_once(dispatcher, update: Update, failing=transient):
+    await run_once(update.update_id, dispatcher.process_update(update), failing)
+
+
+async def run_once(update_id, coroutine, failing=transient):
+    # Telegram redelivers updates after slow answers and errors; a redelivered update_id reaches no handler
+    if deduplicator is not None and not await deduplicator.claim(update_id):
+        coroutine.close()
+        return
+    errors = []
+    token = handler_errors.set(errors)
+    try:
+        await coroutine
+        failed = [error for error in errors if failing(error)]
+        if failed:
+            # fails the update, so the webhook call or the queue message is retried
+            raise failed[0]
+    except Exception as e:
+        if not failing(e):
+            # a retry would fail the same way and repeat what the update already sent, so it counts as handled
+            logging.error("[App] Update " + str(update_id) + " failed")
+            logging.error(e)
+            return
+        if deduplicator is not None:
+            await deduplicator.release(update_id)
+        raise
+    finally:
+        handler_errors.reset(token)
+
+
+async def respond(dispatcher, update: Update, reply):
+    await dispatcher.process_update(update)
+    if unflushed():
+        # the S3 writes after it would hold the webhook response up longer than sending the reply takes
+        await reply.send()
+
+
+async def flush(force=False):
+    # S3 writes batched up while processing: shared cache entries, photo file_ids and BrickLink usage, which is
+    # only written every few updates unless forced
+    await flush_shared_tier()
+    await governor.flush(force)
+
+
+def unflushed() -> bool:
+    return pending_writes() or governor.flush_due()
+
+
+def chat_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+async def run_batch(records) -> list:
+    dispatcher = await get_application()
+    failures = []
+    chats = {}
+    for record in records:
+        try:
+            update = Update.de_json(json.loads(record["body"]), dispatcher.bot)
+        except Exception as e:
+            logging.error("[App] Unreadable update in message " + record["messageId"])
+            logging.error(e)
+            failures.append(record["messageId"])
+            continue
+        key = chat_key(update)
+        chats.setdefault(record["messageId"] if key is None else key, []).append((record["messageId"], update))
+    logging.debug("[App] Batch of " + str(len(records)) + " updates from " + str(len(chats)) + " chats")
+    # chats run concurrently, the updates of one chat in the order they were queued
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    for failed in await asyncio.gather(*(run_chat(dispatcher, updates, semaphore) for updates in chats.values())):
+        failures.extend(failed)
+    await flush()
+    logging.debug("[App] BrickLink cache stats: " + str(cache.stats()))
+    return failures
+
+
+async def run_chat(dispatcher, updates, semaphore) -> list:
+    for index, (message_id, update) in enumerate(updates):
+        try:
+            async with semaphore:
+                with tracing.trace(update.update_id, "batch"):
+                    # a message that always fails is retried until the redrive policy of the queue moves it aside
+                    await process_once(dispatcher, update, every_error)
+        except Exception as e:
+            logging.error("[App] Update " + str(update.update_id) + " failed")
+            logging.error(e)
+            # the rest of this chat is retried with it rather than answered out of order
+            return [message_id for message_id, update in updates[index:]]
+    return []
+
+
+async def run_valuation(event, context):
+    dispatcher = await get_application()
+    job = await asyncio.to_thread(load_job, event["job_id"])
+    if job is None:
+        logging.warning("[App] Valuation job " + event["job_id"] + " not found")
+        return
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - VALUATION_SAFETY_MARGIN
+    with tracing.trace(job.job_id, "valuation"):
+        await advance_job(job, dispatcher.bot, deadline, worker=True)
+        await flush()
+
+
+def shutdown():
+    global application, loop
+    if loop is None or loop.is_closed():
+        return
+    if application is not None:
+        logging.debug("[App] Shutting down application")
+        loop.run_until_complete(application.shutdown())
+        application = None
+    loop.run_until_complete(client.close())
+    loop.run_until_complete(rebrickable_client.client.close())
+    loop.close()
+    loop = None
+
 
-    await dispatcher.shutdown()
+atexit.register(shutdown)
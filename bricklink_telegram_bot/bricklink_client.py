@@ -1,13 +1,34 @@
+import base64
+import hashlib
+import hmac
 import os
 import logging
+import secrets
+import time
+from urllib.parse import quote, urlencode
 
-from rauth import OAuth1Service
+import httpx
 import json
 
+import tracing
+from quota import governor, endpoint_name, INTERACTIVE
+from singleflight import SingleFlight, request_key
+
 BL_CONSUMER_KEY = os.environ['BL_CONSUMER_KEY']
 BL_CONSUMER_SECRET = os.environ['BL_CONSUMER_SECRET']
 BL_ACCESS_TOKEN = os.environ['BL_ACCESS_TOKEN']
 BL_TOKEN_SECRET = os.environ['BL_TOKEN_SECRET']
+BL_TIMEOUT = float(os.environ.get('BL_TIMEOUT', '2.5'))
+BL_MAX_CONNECTIONS = int(os.environ.get('BL_MAX_CONNECTIONS', '10'))
+BASE_URL = 'https://api.bricklink.com/api/store/v1/'
+# BrickLink's image host rejects requests without a browser-like user agent
+IMAGE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+}
+
+
+class NotFoundError(Exception):
+    pass
 
 
 def process_response(response, method, url, params):
@@ -17,50 +38,120 @@ def process_response(response, method, url, params):
     if meta['code'] not in (200, 201, 204):
         if meta['message'] == 'INVALID_URI':
             raise Exception(meta['description'])
+        if meta['code'] == 404:
+            raise NotFoundError(meta.get('description', url))
 
     data = response['data'] if 'data' in response else []
 
     return data
 
 
-class ApiClient:
-    def __init__(self):
-        logging.debug("[BrickLinkClient] Initializing api client")
-
-        self.service = OAuth1Service(name='bricklink',
-                                     consumer_key=BL_CONSUMER_KEY,
-                                     consumer_secret=BL_CONSUMER_SECRET,
-                                     base_url='https://api.bricklink.com/api/store/v1/')
-        logging.debug("[BrickLinkClient] Creating session")
+def percent_encode(value) -> str:
+    return quote(str(value), safe='~')
 
-        self.session = self.service.get_session((BL_ACCESS_TOKEN, BL_TOKEN_SECRET))
 
-    def request(self, method, url, params):
+def oauth_header(method, url, params) -> str:
+    oauth_params = {
+        'oauth_consumer_key': BL_CONSUMER_KEY,
+        'oauth_token': BL_ACCESS_TOKEN,
+        'oauth_signature_method': 'HMAC-SHA1',
+        'oauth_timestamp': str(int(time.time())),
+        'oauth_nonce': secrets.token_hex(16),
+        'oauth_version': '1.0'
+    }
+    signed_params = sorted((percent_encode(k), percent_encode(v))
+                           for k, v in list(params.items()) + list(oauth_params.items()))
+    normalized_params = '&'.join(k + '=' + v for k, v in signed_params)
+    base_string = '&'.join([method.upper(), percent_encode(url), percent_encode(normalized_params)])
+    key = percent_encode(BL_CONSUMER_SECRET) + '&' + percent_encode(BL_TOKEN_SECRET)
+    digest = hmac.new(key.encode('utf-8'), base_string.encode('utf-8'), hashlib.sha1).digest()
+    oauth_params['oauth_signature'] = base64.b64encode(digest).decode('ascii')
+    return 'OAuth ' + ', '.join(k + '="' + percent_encode(v) + '"' for k, v in sorted(oauth_params.items()))
 
-        if method in ('POST', 'PUT', 'DELETE'):
-            response = self.session.request(method, url, True, '', data=json.dumps(params),
-                                            headers={'Content-Type': 'application/json'})
-        else:
-            response = self.session.request(method, url, True, '', params=params)
-        responseJson = json.loads(response.content)
-        return process_response(responseJson, method, url, params)
 
-    def get(self, url, params=None):
+class ApiClient:
+    def __init__(self, timeout=BL_TIMEOUT, max_connections=BL_MAX_CONNECTIONS, quota=governor):
+        logging.debug("[BrickLinkClient] Initializing api client")
+        self.quota = quota
+        self.inflight = SingleFlight()
+        self.timeout = timeout
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.session = None
+
+    def get_session(self) -> httpx.AsyncClient:
+        # The session is bound to the running event loop on first use, so it is created lazily.
+        if self.session is None or self.session.is_closed:
+            logging.debug("[BrickLinkClient] Creating session")
+            self.session = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.session
+
+    async def request(self, method, url, params, timeout=None, priority=INTERACTIVE):
+        if method == 'GET':
+            return await self.inflight.do(request_key(method, url, params),
+                                          lambda: self.send(method, url, params, timeout, priority))
+        return await self.send(method, url, params, timeout, priority)
+
+    async def send(self, method, url, params, timeout=None, priority=INTERACTIVE):
+        if self.quota is not None:
+            await self.quota.acquire(url, priority)
+        full_url = BASE_URL + url
+        timeout = self.timeout if timeout is None else timeout
+        with tracing.span('bricklink', endpoint_name(url)) as call:
+            if method in ('POST', 'PUT', 'DELETE'):
+                headers = {
+                    'Authorization': oauth_header(method, full_url, {}),
+                    'Content-Type': 'application/json'
+                }
+                response = await self.get_session().request(method, full_url, content=json.dumps(params),
+                                                            headers=headers, timeout=timeout)
+            else:
+                headers = {'Authorization': oauth_header(method, full_url, params)}
+                if params:
+                    full_url = full_url + '?' + urlencode(params, quote_via=quote, safe='~')
+                response = await self.get_session().request(method, full_url, headers=headers, timeout=timeout)
+            call.bytes = len(response.content)
+            if response.status_code != 200:
+                call.status = str(response.status_code)
+            return process_response(response.json(), method, url, params)
+
+    async def get(self, url, params=None, timeout=None, priority=INTERACTIVE):
         if params is None:
             params = {}
-        return self.request('GET', url, params)
+        return await self.request('GET', url, params, timeout, priority)
 
-    def post(self, url, params=None):
+    async def post(self, url, params=None, timeout=None, priority=INTERACTIVE):
         if params is None:
             params = {}
-        return self.request('POST', url, params)
+        return await self.request('POST', url, params, timeout, priority)
 
-    def put(self, url, params=None):
+    async def put(self, url, params=None, timeout=None, priority=INTERACTIVE):
         if params is None:
             params = {}
-        return self.request('PUT', url, params)
+        return await self.request('PUT', url, params, timeout, priority)
 
-    def delete(self, url, params=None):
+    async def delete(self, url, params=None, timeout=None, priority=INTERACTIVE):
         if params is None:
             params = {}
-        return self.request('DELETE', url, params)
+        return await self.request('DELETE', url, params, timeout, priority)
+
+    async def download(self, url, timeout=None):
+        return await self.inflight.do(request_key('GET', url), lambda: self.fetch(url, timeout))
+
+    async def fetch(self, url, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with tracing.span('image', 'bricklink') as call:
+            try:
+                response = await self.get_session().get(url, headers=IMAGE_HEADERS, timeout=timeout)
+                call.bytes = len(response.content)
+                response.raise_for_status()
+                return response.content
+            except httpx.HTTPError as e:
+                logging.error("[BrickLinkClient] Failed to download " + url)
+                logging.error(e)
+                call.status = tracing.error_status(e)
+                return None
+
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
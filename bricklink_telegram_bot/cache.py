@@ -0,0 +1,197 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+from botocore.exceptions import ClientError
+
+import tracing
+from s3_client import BUCKET, get_client
+
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '512'))
+CATALOG_TTL = int(os.environ.get('CATALOG_CACHE_TTL', str(24 * 60 * 60)))
+PRICE_GUIDE_TTL = int(os.environ.get('PRICE_GUIDE_CACHE_TTL', str(3 * 60 * 60)))
+NEGATIVE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', str(15 * 60)))
+S3_CACHE_ENABLED = os.environ.get('S3_CACHE_ENABLED', 'false').lower() == 'true'
+S3_CACHE_PREFIX = os.environ.get('S3_CACHE_PREFIX', 'cache/')
+S3_CACHE_WRITERS = int(os.environ.get('S3_CACHE_WRITERS', '4'))
+PHOTO_CACHE_ENABLED = os.environ.get('PHOTO_CACHE_ENABLED', 'true').lower() == 'true'
+PHOTO_CACHE_PREFIX = os.environ.get('PHOTO_CACHE_PREFIX', 'photos/')
+
+MISSING = object()
+
+
+def cache_key(url, params=None) -> str:
+    if not params:
+        return url
+    return url + '?' + urlencode(sorted(params.items()))
+
+
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries[key] = (value, time.time() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class S3CacheTier:
+    def __init__(self, bucket=BUCKET, prefix=S3_CACHE_PREFIX, s3=None, max_workers=S3_CACHE_WRITERS):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3
+        self.max_workers = max_workers
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def client(self):
+        if self.s3 is None:
+            self.s3 = get_client()
+        return self.s3
+
+    def object_key(self, key) -> str:
+        return self.prefix + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+    def get(self, key, ttl):
+        # Objects written more than a TTL ago are never downloaded: S3 answers 304 Not Modified for them.
+        modified_since = datetime.now(timezone.utc) - timedelta(seconds=ttl)
+        try:
+            with tracing.span('s3', 'cache/get') as call:
+                response = self.client().get_object(Bucket=self.bucket, Key=self.object_key(key),
+                                                    IfModifiedSince=modified_since)
+                call.bytes = response.get('ContentLength')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '304', 'NotModified'):
+                raise
+            self.misses += 1
+            return MISSING, None
+        expires_at = float(response['Metadata'].get('expires-at', '0'))
+        if expires_at <= time.time():
+            self.misses += 1
+            return MISSING, None
+        self.hits += 1
+        return json.loads(response['Body'].read()), expires_at
+
+    def put(self, key, value, expires_at):
+        self.pending[key] = (value, expires_at)
+
+    def write(self, key, value, expires_at):
+        try:
+            body = json.dumps(value).encode('utf-8')
+            with tracing.span('s3', 'cache/put') as call:
+                call.bytes = len(body)
+                self.client().put_object(Bucket=self.bucket, Key=self.object_key(key), Body=body,
+                                         ContentType='application/json',
+                                         Metadata={'expires-at': str(int(expires_at))})
+            self.writes += 1
+        except Exception as e:
+            logging.error("[Cache] Failed to write " + key + " to S3")
+            logging.error(e)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        logging.debug("[Cache] Flushing " + str(len(pending)) + " entries to S3")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for key, (value, expires_at) in pending.items():
+                # each write runs in a copy of the caller's context, so its span joins the current trace
+                executor.submit(contextvars.copy_context().run, self.write, key, value, expires_at)
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes,
+            'pending': len(self.pending)
+        }
+
+
+class TieredCache:
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    async def get(self, key, ttl):
+        value = self.local.get(key)
+        if value is not MISSING or self.shared is None:
+            return value
+        try:
+            value, expires_at = await asyncio.to_thread(self.shared.get, key, ttl)
+        except Exception as e:
+            logging.error("[Cache] Failed to read " + key + " from S3")
+            logging.error(e)
+            return MISSING
+        if value is not MISSING:
+            self.local.set(key, value, expires_at - time.time())
+        return value
+
+    def set(self, key, value, ttl):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.put(key, value, time.time() + ttl)
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        if self.shared is not None:
+            stats['s3'] = self.shared.stats()
+        return stats
+
+
+shared_tier = S3CacheTier() if S3_CACHE_ENABLED else None
+# Telegram file_ids of uploaded photos: unlike responses they never go stale, so they are kept across cold starts
+# whether or not responses are shared
+photo_tier = S3CacheTier(prefix=PHOTO_CACHE_PREFIX) if PHOTO_CACHE_ENABLED else None
+
+
+def pending_writes() -> bool:
+    return any(tier is not None and tier.pending for tier in (shared_tier, photo_tier))
+
+
+async def flush_shared_tier():
+    # Called once the reply is sent, so batched S3 writes never delay it
+    for tier in (shared_tier, photo_tier):
+        if tier is not None and tier.pending:
+            await asyncio.to_thread(tier.flush)
@@ -0,0 +1,71 @@
+import logging
+
+# callback_data layout: version, action code, item type code, condition code, then the item number or query text
+CALLBACK_VERSION = '1'
+CALLBACK_DATA_LIMIT = 64
+NONE_CODE = '-'
+ACTIONS = {
+    'INFO': 'i',
+    'more': 'g',
+    'PRICE': 'p',
+    'SOLD': 's',
+    'STOCK': 'k',
+    'SUBSET': 'b',
+    'SUPERSET': 'u',
+    'SETSEARCH': 'S',
+    'MINIFIGSEARCH': 'F',
+    'VALUATION': 'V'
+}
+ACTION_NAMES = {code: action for action, code in ACTIONS.items()}
+ITEM_TYPES = {
+    'SET': 'S',
+    'MINIFIG': 'M',
+    'PART': 'P',
+    'BOOK': 'B',
+    'GEAR': 'G',
+    'CATALOG': 'C',
+    'INSTRUCTION': 'I',
+    'ORIGINAL_BOX': 'O'
+}
+ITEM_TYPE_NAMES = {code: item_type for item_type, code in ITEM_TYPES.items()}
+LEGACY_CONDITIONS = {'NEW': 'N', 'USED': 'U'}
+CONDITION_ACTIONS = ('PRICE', 'SOLD', 'STOCK')
+
+
+class Callback:
+    def __init__(self, action, payload, item_type=None, condition=None):
+        self.action = action
+        self.payload = payload
+        self.item_type = item_type
+        self.condition = condition
+
+
+def encode(action, payload, item_type=None, condition=None) -> str:
+    data = CALLBACK_VERSION + ACTIONS[action] + ITEM_TYPES.get(item_type, NONE_CODE) + (condition or NONE_CODE) + payload
+    encoded = data.encode('utf-8')
+    if len(encoded) > CALLBACK_DATA_LIMIT:
+        # only free text queries get this long; cut them on a whole character
+        data = encoded[:CALLBACK_DATA_LIMIT].decode('utf-8', 'ignore')
+    return data
+
+
+def decode(data):
+    if data and data[0] == CALLBACK_VERSION and len(data) >= 4 and data[1] in ACTION_NAMES:
+        return Callback(ACTION_NAMES[data[1]], data[4:], ITEM_TYPE_NAMES.get(data[2]),
+                        None if data[3] == NONE_CODE else data[3])
+    return decode_legacy(data)
+
+
+def decode_legacy(data):
+    # Buttons sent before the compact encoding look like "PRICE NEW 75100-1" or "more sw0547"
+    action, _, payload = (data or '').partition(' ')
+    if action not in ACTIONS:
+        logging.warning("[Callbacks] Unknown callback data: " + str(data))
+        return None
+    condition = None
+    if action in CONDITION_ACTIONS:
+        state, _, rest = payload.partition(' ')
+        condition = LEGACY_CONDITIONS.get(state)
+        if condition:
+            payload = rest
+    return Callback(action, payload.strip(), None, condition)
@@ -0,0 +1,73 @@
+import logging
+
+from s3_client import write_minifigs_to_file, get_minifigure_index, normalize_name
+
+CATALOG_FIELDS = ('ITEMID', 'ITEMNAME', 'ITEMYEAR')
+
+
+class CatalogFormatError(Exception):
+    pass
+
+
+def iter_xml_items(stream, required_fields, optional_fields=()):
+    # Fed line by line so errors can point at a line; each item is dropped from the tree once yielded.
+    # Only uploads need the XML parser, so it is not imported with the bot.
+    import xml.etree.ElementTree as ET
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    line_number = 0
+    try:
+        for line_number, line in enumerate(stream, 1):
+            parser.feed(line)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                fields = {tag: element.findtext(tag) for tag in required_fields}
+                missing = [tag for tag, value in fields.items() if value is None]
+                if missing:
+                    raise CatalogFormatError("Line " + str(line_number) + ": " + element.tag + " has no "
+                                             + ", ".join(missing))
+                for tag in optional_fields:
+                    fields[tag] = element.findtext(tag)
+                yield line_number, fields
+                root.clear()
+        parser.close()
+    except ET.ParseError as e:
+        raise CatalogFormatError("Line " + str(line_number) + ": " + str(e))
+
+
+def iter_catalog_rows(stream):
+    for line_number, fields in iter_xml_items(stream, CATALOG_FIELDS):
+        yield fields['ITEMID'], fields['ITEMNAME'], fields['ITEMYEAR']
+
+
+def import_catalog(path, merge=False) -> str:
+    with open(path, 'rb') as stream:
+        if not merge:
+            count = write_minifigs_to_file(iter_catalog_rows(stream))
+            logging.info("[CatalogIngest] Catalog replaced with " + str(count) + " minifigures")
+            return "Successfully updated. " + str(count) + " minifigures in catalog."
+        updates = {code: (normalize_name(name), year) for code, name, year in iter_catalog_rows(stream)}
+    rows = []
+    changed = 0
+    for row in get_minifigure_index(refresh=True).rows():
+        update = updates.pop(row['num'], None)
+        if update is not None and update != (row['name'], row['year']):
+            changed += 1
+            rows.append((row['num'],) + update)
+        else:
+            rows.append((row['num'], row['name'], row['year']))
+    added = len(updates)
+    if added == 0 and changed == 0:
+        return "Catalog is already up to date."
+    rows.extend((code,) + update for code, update in updates.items())
+    write_minifigs_to_file(rows)
+    logging.info("[CatalogIngest] Merged catalog: " + str(added) + " added, " + str(changed) + " changed")
+    return "Successfully updated. " + str(added) + " added, " + str(changed) + " changed."
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from s3_client import BUCKET, get_client
+
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').lower() == 'true'
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', '4096'))
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', str(60 * 60)))
+DEDUP_STORE_ENABLED = os.environ.get('DEDUP_STORE_ENABLED', 'false').lower() == 'true'
+DEDUP_PREFIX = os.environ.get('DEDUP_PREFIX', 'updates/')
+# how long a claim in the store holds; must cover the function timeout
+DEDUP_LEASE = int(os.environ.get('DEDUP_LEASE', '10'))
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409')
+
+
+class S3UpdateStore:
+    # One object per update holding the time its claim lapses, created only if it does not exist yet: whichever
+    # container creates it owns the update. No invocation outlives the lease and Telegram and SQS only redeliver
+    # what failed, so a redelivery after it lapsed was left by a killed invocation and takes the claim over.
+    # A lifecycle rule on the prefix can expire the objects.
+    def __init__(self, bucket=BUCKET, prefix=DEDUP_PREFIX, s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3
+
+    def client(self):
+        if self.s3 is None:
+            self.s3 = get_client()
+        return self.s3
+
+    def claim(self, update_id, lease) -> bool:
+        key = self.prefix + str(update_id)
+        lease_body = str(int(time.time() + lease)).encode('utf-8')
+        if self.put(key, lease_body, IfNoneMatch='*'):
+            return True
+        try:
+            response = self.client().get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            # released in the meantime
+            return self.put(key, lease_body, IfNoneMatch='*')
+        body = response['Body'].read()
+        if float(body or 0) > time.time():
+            return False
+        logging.info("[Dedup] Taking over the lapsed claim on update " + str(update_id))
+        return self.put(key, lease_body, IfMatch=response['ETag'])
+
+    def put(self, key, body, **conditions) -> bool:
+        try:
+            self.client().put_object(Bucket=self.bucket, Key=key, Body=body, **conditions)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICT_CODES:
+                raise
+            return False
+
+    def release(self, update_id):
+        self.client().delete_object(Bucket=self.bucket, Key=self.prefix + str(update_id))
+
+
+class UpdateDeduplicator:
+    def __init__(self, window=DEDUP_WINDOW, ttl=DEDUP_TTL, lease=DEDUP_LEASE, store=None):
+        self.window = window
+        self.ttl = ttl
+        self.lease = lease
+        self.store = store
+        self.seen = OrderedDict()
+        self.duplicates = 0
+
+    async def claim(self, update_id) -> bool:
+        now = time.time()
+        expires_at = self.seen.get(update_id)
+        if expires_at is not None and expires_at > now:
+            self.duplicates += 1
+            logging.info("[Dedup] Dropping duplicate update " + str(update_id))
+            return False
+        # remembered before the store is asked, so a copy arriving meanwhile in this process is dropped too
+        self.seen[update_id] = now + self.ttl
+        self.seen.move_to_end(update_id)
+        while len(self.seen) > self.window:
+            self.seen.popitem(last=False)
+        if self.store is None:
+            return True
+        try:
+            claimed = await asyncio.to_thread(self.store.claim, update_id, self.lease)
+        except Exception as e:
+            # an unreachable store must not cost the user the reply
+            logging.error("[Dedup] Failed to claim update " + str(update_id))
+            logging.error(e)
+            return True
+        if not claimed:
+            # the owner may still release it, so only the store decides for this update from now on
+            self.seen.pop(update_id, None)
+            self.duplicates += 1
+            logging.info("[Dedup] Update " + str(update_id) + " already claimed by another container")
+        return claimed
+
+    async def release(self, update_id):
+        # processing failed in a way a retry may get past, so the retry has to get through
+        self.seen.pop(update_id, None)
+        if self.store is None:
+            return
+        try:
+            await asyncio.to_thread(self.store.release, update_id)
+        except Exception as e:
+            logging.error("[Dedup] Failed to release update " + str(update_id))
+            logging.error(e)
+
+    def stats(self) -> dict:
+        return {
+            'remembered': len(self.seen),
+            'duplicates': self.duplicates
+        }
+
+
+deduplicator = UpdateDeduplicator(store=S3UpdateStore() if DEDUP_STORE_ENABLED else None) if DEDUP_ENABLED else None
@@ -1,19 +1,33 @@
+import asyncio
 import os
 import logging
-import xml.etree.ElementTree as ET
+import tempfile
+import time
+from contextlib import asynccontextmanager
 from io import BytesIO
 
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat, InputFile
+from telegram.constants import ChatAction
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 
 from authorization import is_admin
-from s3_client import minifigure_search_request, write_minifigs_to_file
-from rebrickable_client import set_search_request
+from tracing import traced, span
+from callbacks import encode, decode
+from cache import ResponseCache, TieredCache, MISSING, photo_tier
+from s3_client import minifigure_search_request
+from catalog_ingest import import_catalog, CatalogFormatError
+from rebrickable_client import set_search_request, RebrickableError
+from set_catalog import search_sets
+from webhook_reply import as_webhook_reply
+from quota import QuotaExceeded
+from valuation import create_job, load_job, advance_job, VALUATION_TIME_BUDGET
 from response_formatters import format_info_response, format_price_response, format_items_sold_response, \
     format_items_for_sale_response, set_search_response_formatter, fig_search_response_formatter, search_response_formatter, \
-    escape, subset_response_formatter, superset_response_formatter
-from request_matcher import resolve_price, resolve_info, resolve_sold, resolve_subsets, resolve_supersets
+    escape, subset_response_formatter, superset_response_formatter, format_price_table_response
+from request_matcher import resolve_price, resolve_info, resolve_sold, resolve_subsets, resolve_supersets, \
+    resolve_request, resolve_availability, resolve_requests, resolve_prices, client, InfoRequest, \
+    as_request
 
 BOT_NAME = os.environ['BOT_NAME']
 HELP_TEXT = "Try typing in set number, name or minifigure number to get more info on it.\n" \
@@ -22,19 +36,29 @@ HELP_TEXT = "Try typing in set number, name or minifigure number to get more inf
             "/info 42069 or /price col404\n" \
             "You can also use /search command to find set numbers (currently not working for minifigures)\n" \
             "Example: /search hotel"
+BUSY_TEXT = "BrickLink is busy right now, please try again in a minute."
 START_TEXT = "What are you looking for? Try typing set/minifigure number or name, for example 4950, " \
              "sw0547 or fishing store."
 BL_URL = "https://www.bricklink.com/v2/catalog/catalogitem.page?{}={}"
+PHOTO_FILE_ID_TTL = int(os.environ.get('PHOTO_FILE_ID_TTL', str(30 * 24 * 60 * 60)))
+CHAT_ACTION_DELAY = float(os.environ.get('CHAT_ACTION_DELAY', '0.3'))
+# buttons whose handler answers the query itself, with a url or a text
+SELF_ANSWERED_ACTIONS = ("more",)
 
+# Telegram file_ids of item images already uploaded by this bot, keyed by BrickLink image URL
+photo_cache = TieredCache(ResponseCache(), photo_tier)
 
+
+@traced("handler")
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] Processing start command")
-    await context.bot.send_message(
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=HELP_TEXT
-    )
+    ))
 
 
+@traced("handler")
 async def search_dialog_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     request_str = None
     logging.info("[Handlers] Processing search by name request")
@@ -46,15 +70,16 @@ async def search_dialog_handler(update: Update, context: ContextTypes.DEFAULT_TY
     logging.info("[Handlers] Argument: " + request_str)
     response_keyboard = search_response_formatter(request_str)
     response = escape("Is '" + request_str + "' Set or Minifigure?")
-    await context.bot.send_message(
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response,
         reply_markup=InlineKeyboardMarkup(response_keyboard),
         parse_mode='MarkdownV2'
-    )
+    ))
 
 
-async def set_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def set_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback=None):
     response = None
     reply_markup = None
     request_str = None
@@ -66,10 +91,23 @@ async def set_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif update.message and len(update.message.text.replace('/search_set', '').strip()) > 0:
         request_str = update.message.text.replace('/search_set', '').strip()
         logging.info("[Handlers] Argument using update message: " + request_str)
-    elif update.callback_query:
-        request_str = update.callback_query.data.replace("SETSEARCH", '').strip()
+    elif callback is not None:
+        request_str = callback.payload.strip()
         logging.info("[Handlers] Argument using callback query: " + request_str)
-    re_response = set_search_request(request_str)
+    re_response = None
+    async with chat_action(update, context):
+        try:
+            re_response = await asyncio.to_thread(search_sets, request_str)
+        except Exception as e:
+            logging.error("[Handlers] Local set catalog search failed")
+            logging.error(e)
+        if not re_response or not re_response["results"]:
+            # the local mirror may not be published yet or may predate a brand-new set
+            try:
+                re_response = await set_search_request(request_str)
+            except RebrickableError as e:
+                logging.error(e)
+                re_response = None
     if re_response:
         target = "more" if (update.effective_chat.type == Chat.SUPERGROUP
                             or update.effective_chat.type == Chat.GROUP) else "INFO"
@@ -79,15 +117,18 @@ async def set_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             response = escape("Search result for '" + request_str + "'")
         else:
             response = escape("Nothing found for: " + request_str)
-    await context.bot.send_message(
+    else:
+        response = escape("Nothing found for: " + request_str)
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response,
         reply_markup=reply_markup,
         parse_mode='MarkdownV2'
-    )
+    ))
 
 
-async def minifigure_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def minifigure_search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback=None):
     reply_markup = None
     request_str = None
     logging.info("[Handlers] Processing search minifigure command")
@@ -96,10 +137,11 @@ async def minifigure_search_handler(update: Update, context: ContextTypes.DEFAUL
         request_str = request_str.join(context.args)
     elif update.message and len(update.message.text.replace('/search_fig', '').strip()) > 0:
         request_str = update.message.text.replace('/search_fig', '').strip()
-    elif update.callback_query:
-        request_str = update.callback_query.data.replace("MINIFIGSEARCH", '').strip()
+    elif callback is not None:
+        request_str = callback.payload.strip()
     logging.info("[Handlers] Argument: " + request_str)
-    re_response = minifigure_search_request(request_str)
+    async with chat_action(update, context):
+        re_response = await asyncio.to_thread(minifigure_search_request, request_str)
     logging.debug("[Handlers] Received response from S3 client.")
     if re_response and len(re_response) != 0:
         logging.debug('[Handlers] Forming bot reply for minifigure search.')
@@ -113,189 +155,322 @@ async def minifigure_search_handler(update: Update, context: ContextTypes.DEFAUL
             response = escape("Nothing found for: " + request_str)
     else:
         response = escape("Nothing found for: " + request_str)
-    await context.bot.send_message(
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response,
         reply_markup=reply_markup,
         parse_mode='MarkdownV2'
-    )
+    ))
 
 
+@traced("handler")
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] Processing start command")
     if context.args and context.args[0] and len(context.args[0]) > 0:
         reply_markup = None
         try:
             logging.info("[Handlers] Argument: " + str(context.args[0]))
-            response = resolve_info(context.args[0])
+            async with chat_action(update, context):
+                response, available, image = await resolve_info_card(context.args[0], with_image=False)
             if response:
                 itemNumber = response['no']
                 reply_markup = InlineKeyboardMarkup(resolve_item_info_keyboard(update, item_number=itemNumber,
                                                                                item_type=response["type"]))
-                response = format_info_response(response)
+                response = format_info_response(response, available)
+        except QuotaExceeded as e:
+            logging.warning("[Handlers] " + str(e))
+            await respond_busy(update, context)
+            return
         except Exception as e:
             logging.error(e)
             response = e
         if response is None or len(response) == 0:
             response = escape("Can't find anything for " + context.args[0])
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=response, reply_markup=reply_markup,
-                                       parse_mode='MarkdownV2')
+        await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                        reply_markup=reply_markup, parse_mode='MarkdownV2'))
     else:
-        await context.bot.send_message(
+        await as_webhook_reply(context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=escape(START_TEXT),
             parse_mode='MarkdownV2'
-        )
+        ))
 
 
+@traced("handler")
 async def info_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] Processing info request")
     reply_markup = None
     response = None
     formatted_response = None
+    image = None
     try:
         query = update.message.text.lower()
         logging.info("[Handlers] Argument: " + str(query))
-        response = resolve_info(query)
+        async with chat_action(update, context):
+            response, available, image = await resolve_info_card(query)
         if response:
             itemNumber = response['no']
             reply_markup = InlineKeyboardMarkup(resolve_item_info_keyboard(update, item_number=itemNumber,
                                                                            item_type=response["type"]))
-            formatted_response = format_info_response(response)
+            formatted_response = format_info_response(response, available)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
     if formatted_response is None or len(formatted_response) == 0:
         await set_search_handler(update, context)
     else:
-        await respond_info(context, formatted_response, reply_markup, response, update)
+        await respond_info(context, formatted_response, reply_markup, response, update, image)
 
+@traced("handler")
 async def file_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] File handler.")
     logging.info("[Handlers] Argument: " + update.message.document.file_id)
     logging.info("[Handlers] Sender: " + update.message.from_user.name)
     response = "Failed to update."
-    if is_admin(update.message.from_user):
-        try:
-            file = await context.bot.get_file(update.message.document)
-            bytecontent = bytes(await file.download_as_bytearray())
-            root = ET.XML(bytecontent)
-            minifig_dict = {}
-            mapped = True
-            for child in root:
-                itemid = child.find('ITEMID')
-                itemname = child.find('ITEMNAME')
-                itemyear = child.find('ITEMYEAR')
-                if itemid is None or itemyear is None or itemname is None:
-                    response = ("Invalid file format. "
-                                "Make sure you are using valid Bricklink XML and don't forget to include a year.")
-                    mapped = False
-                    break
-                minifig_dict[itemid.text] = {
-                    'name': itemname.text,
-                    'year': itemyear.text
-                }
-            if mapped:
-                write_minifigs_to_file(minifig_dict)
-                response = "Successfully updated."
-        except Exception as e:
-            logging.error(e)
-            response = "Can not read file. Make sure it has a valid Bricklink XML format."
-    else:
-        response = "Forbidden."
-    await context.bot.send_message(
+    caption = (update.message.caption or "").lower()
+    # Anyone can have a wanted list or inventory valued, admins ask for it in the caption
+    if not is_admin(update.message.from_user) or "value" in caption:
+        await valuation_file_handler(update, context)
+        return
+    merge = "merge" in caption
+    try:
+        file = await context.bot.get_file(update.message.document)
+        with tempfile.TemporaryDirectory() as directory:
+            path = await file.download_to_drive(os.path.join(directory, "catalog.xml"))
+            response = await asyncio.to_thread(import_catalog, path, merge)
+    except CatalogFormatError as e:
+        logging.error(e)
+        response = ("Invalid file format. "
+                    "Make sure you are using valid Bricklink XML and don't forget to include a year. " + str(e))
+    except Exception as e:
+        logging.error(e)
+        response = "Can not read file. Make sure it has a valid Bricklink XML format."
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response
-    )
+    ))
 
 
+@traced("handler")
+async def valuation_file_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("[Handlers] Processing valuation request")
+    document = update.message.document
+    response = None
+    job = None
+    try:
+        file = await context.bot.get_file(document)
+        with tempfile.TemporaryDirectory() as directory:
+            path = await file.download_to_drive(os.path.join(directory, "list.xml"))
+            job = await asyncio.to_thread(create_job, path, update.effective_chat.id, document.file_name or "list.xml")
+        if not job.lots:
+            response = "No items found in " + job.file_name + "."
+    except CatalogFormatError as e:
+        logging.error(e)
+        response = "Invalid file format. Make sure you are sending a Bricklink wanted list or inventory XML. " + str(e)
+    except Exception as e:
+        logging.error(e)
+        response = "Can not read file. Make sure it has a valid Bricklink XML format."
+    if response is not None:
+        await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response))
+        return
+    message = await context.bot.send_message(chat_id=update.effective_chat.id, text=job.progress_text())
+    job.message_id = message.message_id
+    await advance_job(job, context.bot, time.monotonic() + VALUATION_TIME_BUDGET)
+
+
+@traced("handler")
+async def valuation_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
+    query = update.callback_query
+    logging.info("[Handlers] Valuation button")
+    logging.info("[Handlers] Argument: " + query.data)
+    job = await asyncio.to_thread(load_job, callback.payload)
+    if job is None or job.chat_id != update.effective_chat.id:
+        await as_webhook_reply(query.edit_message_text(text="This valuation is no longer available."))
+        return
+    await advance_job(job, context.bot, time.monotonic() + VALUATION_TIME_BUDGET)
+
+
+@traced("handler")
 async def info_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] Processing info message handler")
+    # most group messages are not about items and get no reply, so nobody is shown typing there
+    in_group = update.effective_chat.type == Chat.SUPERGROUP or update.effective_chat.type == Chat.GROUP
+    # numbers in group chatter would cost a BrickLink call each, so groups price several items only with /price
+    if not in_group and len(resolve_requests(update.message.text.lower())) > 1:
+        await price_batch_handler(update, context)
+        return
     reply_markup = None
     response = None
     formatted_response = None
+    image = None
     try:
         query = update.message.text.lower()
         logging.info("[Handlers] Argument: " + str(query))
-        response = resolve_info(query)
+        async with chat_action(update, context, show=not in_group):
+            response, available, image = await resolve_info_card(query)
         if response and response['no']:
             itemNumber = response['no']
             reply_markup = InlineKeyboardMarkup(resolve_item_info_keyboard(update, item_number=itemNumber,
                                                                            item_type=response["type"]))
-            formatted_response = format_info_response(response)
+            formatted_response = format_info_response(response, available)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        if not in_group:
+            await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
-    if (formatted_response is None or len(formatted_response) == 0) \
-            and (update.effective_chat.type != Chat.SUPERGROUP and update.effective_chat.type != Chat.GROUP):
-        await search_dialog_handler(update, context)
-    else:
-        await respond_info(context, formatted_response, reply_markup, response, update)
-
-
-async def respond_info(context, formatted_response, reply_markup, response, update):
-    if response["image_url"]:
+    if formatted_response is None or len(formatted_response) == 0:
+        # in a group this was just a message that happened to contain a number, so it gets no reply
+        if not in_group:
+            await search_dialog_handler(update, context)
+        return
+    await respond_info(context, formatted_response, reply_markup, response, update, image)
+
+
+async def resolve_info_card(message, with_image=True):
+    # The availability lookups and the image only run once the catalog knows the item, so an unknown number
+    # costs one BrickLink call; for a known one they run alongside each other.
+    info_request = as_request(message)
+    if info_request.itemType is None:
+        return None, None, None
+    response = await resolve_info(info_request)
+    if not response:
+        return response, None, None
+    available, image = await asyncio.gather(resolve_availability(info_request.itemType, info_request.itemNumber),
+                                            download_image(response if with_image else None),
+                                            return_exceptions=True)
+    if isinstance(available, Exception):
+        logging.error(available)
+        available = None
+    if isinstance(image, Exception):
+        logging.error(image)
+        image = None
+    return response, available, image
+
+
+async def download_image(response):
+    if not response or not response["image_url"]:
+        return None
+    image_url = "https:" + response["image_url"]
+    with span('cache', 'photo') as lookup:
+        file_id = await photo_cache.get(image_url, PHOTO_FILE_ID_TTL)
+        lookup.cache = 'miss' if file_id is MISSING else 'hit'
+    if file_id is not MISSING:
+        logging.debug("[Handlers] Reusing uploaded photo for " + image_url)
+        return file_id
+    logging.debug("[Handlers] Image URL: " + image_url)
+    return await client.download(image_url)
+
+
+async def respond_info(context, formatted_response, reply_markup, response, update, image=None):
+    if isinstance(image, str):
+        # a file_id of a photo Telegram already has: nothing to download or upload
         try:
-            image_url = "https:" + response["image_url"]
-            logging.debug("[Handlers] Image URL: " + image_url)
-            #scummy hack
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
-            }
-
-            image_response = requests.get(image_url, headers=headers)
-            image_response.raise_for_status()
-            image_file = BytesIO(image_response.content)
-
-            image = InputFile(image_file)
-            image.filename = response["no"] + ".jpg"
             await context.bot.send_photo(photo=image, chat_id=update.effective_chat.id, caption=formatted_response,
                                          reply_markup=reply_markup,
                                          parse_mode='MarkdownV2')
-        except requests.RequestException as e:
-            logging.error(e)
-            await context.bot.send_message(chat_id=update.effective_chat.id, text=formatted_response,
-                                           reply_markup=reply_markup,
-                                           parse_mode='MarkdownV2')
+            return
+        except BadRequest as e:
+            logging.warning("[Handlers] Cached photo rejected: " + str(e))
+            image = await client.download("https:" + response["image_url"])
+    if image:
+        image = InputFile(BytesIO(image))
+        image.filename = response["no"] + ".jpg"
+        message = await context.bot.send_photo(photo=image, chat_id=update.effective_chat.id,
+                                               caption=formatted_response,
+                                               reply_markup=reply_markup,
+                                               parse_mode='MarkdownV2')
+        if message.photo:
+            photo_cache.set("https:" + response["image_url"], message.photo[-1].file_id, PHOTO_FILE_ID_TTL)
     else:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=formatted_response,
-                                       reply_markup=reply_markup,
-                                       parse_mode='MarkdownV2')
+        await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=formatted_response,
+                                                        reply_markup=reply_markup,
+                                                        parse_mode='MarkdownV2'))
+
+
+async def respond_busy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # the BrickLink budget is reserved or the rate limit is hit: say so instead of "nothing found"
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=BUSY_TEXT))
+
+
+@asynccontextmanager
+async def chat_action(update: Update, context: ContextTypes.DEFAULT_TYPE, action=ChatAction.TYPING, show=True):
+    # Shows "typing..." while the lookups run, but only once they take longer than CHAT_ACTION_DELAY, so
+    # answers from the cache cost no extra Bot API call
+    if not show:
+        yield
+        return
+    sending = asyncio.Event()
+    task = asyncio.ensure_future(send_chat_action(context.bot, update.effective_chat.id, action, sending))
+    try:
+        yield
+    finally:
+        # an action already on its way is waited for, it must not reach the chat after the reply
+        if not sending.is_set():
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
 
+async def send_chat_action(bot, chat_id, action, sending):
+    await asyncio.sleep(CHAT_ACTION_DELAY)
+    sending.set()
+    try:
+        await bot.send_chat_action(chat_id=chat_id, action=action)
+    except Exception as e:
+        logging.warning("[Handlers] Failed to send chat action: " + str(e))
 
-async def info_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+@traced("handler")
+async def info_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
     query = update.callback_query
     logging.info("[Handlers] Info button")
     logging.info("[Handlers] Argument: " + query.data)
     reply_markup = None
     response = None
     formatted_response = None
+    image = None
     try:
-        itemNumber = query.data.replace("INFO ", "")
-        response = resolve_info(itemNumber)
+        itemNumber = callback.payload
+        async with chat_action(update, context):
+            response, available, image = await resolve_info_card(callback_request(callback))
         if response:
             reply_markup = InlineKeyboardMarkup(resolve_item_info_keyboard(update, item_number=itemNumber,
                                                                            item_type=response["type"]))
-            formatted_response = format_info_response(response)
+            formatted_response = format_info_response(response, available)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
     if formatted_response is None or len(response) == 0:
         formatted_response = escape("Can't find anything for " +
-                          query.data.replace("INFO ", "") +
+                          callback.payload +
                           ". It is possible that this item is missing from BrickLink database.")
-    await query.answer()
-    await respond_info(context, formatted_response, reply_markup, response, update)
+    await respond_info(context, formatted_response, reply_markup, response, update, image)
 
 
-async def subset_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def subset_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
     query = update.callback_query
-    itemNumber = query.data.replace("SUBSET ", "")
+    itemNumber = callback.payload
     logging.info("[Handlers] Subsets button")
     logging.info("[Handlers] Argument: " + query.data)
     reply_markup = None
     response_keyboard = []
     try:
-        response = resolve_subsets(itemNumber)
+        async with chat_action(update, context):
+            response = await resolve_subsets(callback_request(callback))
         if response:
             response_keyboard = subset_response_formatter(response, "INFO")
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
     if len(response_keyboard) > 0:
@@ -303,25 +478,31 @@ async def subset_button_handler(update: Update, context: ContextTypes.DEFAULT_TY
         response_str = escape("Minifigures in '" + itemNumber + "'")
     else:
         response_str = escape("Nothing found in: " + itemNumber)
-    await context.bot.send_message(
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response_str,
         reply_markup=reply_markup,
         parse_mode='MarkdownV2'
-    )
+    ))
 
 
-async def superset_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def superset_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
     query = update.callback_query
-    itemNumber = query.data.replace("SUPERSET ", "")
+    itemNumber = callback.payload
     logging.info("[Handlers] Supersets button")
     logging.info("[Handlers] Argument: " + query.data)
     reply_markup = None
     response_keyboard = []
     try:
-        response = resolve_supersets(itemNumber)
+        async with chat_action(update, context):
+            response = await resolve_supersets(callback_request(callback))
         if response:
             response_keyboard = superset_response_formatter(response, "INFO")
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
     if len(response_keyboard) > 0:
@@ -329,138 +510,233 @@ async def superset_button_handler(update: Update, context: ContextTypes.DEFAULT_
         response_str = escape("Sets containing '" + itemNumber + "'")
     else:
         response_str = escape("No sets found containing: " + itemNumber)
-    await context.bot.send_message(
+    await as_webhook_reply(context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=response_str,
         reply_markup=reply_markup,
         parse_mode='MarkdownV2'
-    )
+    ))
 
 
-async def search_set_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def search_set_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
     query = update.callback_query
     logging.info("[Handlers] Search set button")
     logging.info("[Handlers] Argument: " + query.data)
 
-    await query.answer()
-    await set_search_handler(update, context)
+    await set_search_handler(update, context, callback)
 
 
-async def search_minifigure_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@traced("handler")
+async def search_minifigure_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback):
     query = update.callback_query
     logging.info("[Handlers] Search minifigure button")
     logging.info("[Handlers] Argument: " + query.data)
 
-    await query.answer()
-    await minifigure_search_handler(update, context)
+    await minifigure_search_handler(update, context, callback)
 
 
+@traced("handler")
 async def price_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info("[Handlers] Processing price request")
+    if len(resolve_requests(update.message.text.lower())) > 1:
+        await price_batch_handler(update, context)
+        return
     try:
         query = update.message.text.lower()
         logging.info("[Handlers] Argument: " + str(query))
-        response = resolve_price(query)
+        async with chat_action(update, context):
+            response = await resolve_price(query)
         if response:
             logging.debug("[Handlers] Response from bl: " + str(response))
             response = format_price_response(response)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
         response = e
     if response is None or len(response) == 0:
         response = escape("Cannot find data for " + update.message.text)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=response, parse_mode='MarkdownV2')
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                    parse_mode='MarkdownV2'))
+
+
+@traced("handler")
+async def price_batch_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info("[Handlers] Processing batch price request")
+    query = update.message.text.lower()
+    logging.info("[Handlers] Argument: " + str(query))
+    response = None
+    try:
+        async with chat_action(update, context):
+            results = await resolve_prices(query)
+        if results:
+            response = format_price_table_response(results)
+    except Exception as e:
+        logging.error(e)
+    if response is None:
+        response = escape("Cannot find data for " + update.message.text)
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                    parse_mode='MarkdownV2'))
 
 
-async def group_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("handler")
+async def group_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback) -> None:
     logging.info("[Handlers] Processing group button request")
     query = update.callback_query
     logging.info("[Handlers] Argument: " + str(query))
-    item = query.data.replace("more ", "")
+    item = callback.payload
     await query.answer(url="https://t.me/" + BOT_NAME + "?start=" + item)
 
 
-async def price_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("handler")
+async def price_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback) -> None:
     logging.info("[Handlers] Processing price button request")
     query = update.callback_query
     logging.info("[Handlers] Query data: " + query.data)
-    await query.answer()
     try:
-        response = resolve_price(query.data)
+        async with chat_action(update, context):
+            response = await resolve_price(callback_request(callback))
         if response:
             logging.debug("[Handlers] Response from bl: " + str(response))
             response = format_price_response(response)
 
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
         response = e
     if response is None or response.__sizeof__() == 0:
-        response = escape("Cannot find data for " + query.data)
+        response = escape("Cannot find data for " + callback.payload)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=response, parse_mode='MarkdownV2')
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                    parse_mode='MarkdownV2'))
 
 
-async def sold_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("handler")
+async def sold_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback) -> None:
     query = update.callback_query
     response = None
     logging.info("[Handlers] Processing sold button request")
     logging.info("[Handlers] Query data: " + query.data)
-    await query.answer()
     try:
-        response = resolve_sold(query.data)
+        async with chat_action(update, context):
+            response = await resolve_sold(callback_request(callback, mode="SOLD"))
         if response:
             response = format_items_sold_response(response)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
         # response = str(e)
     if response is None or len(response) == 0:
-        response = escape("Cannot find data for " + query.data)
+        response = escape("Cannot find data for " + callback.payload)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=response, parse_mode='MarkdownV2')
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                    parse_mode='MarkdownV2'))
 
 
-async def stock_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("handler")
+async def stock_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback) -> None:
     query = update.callback_query
     response = None
     logging.info("[Handlers] Processing stock button request")
     logging.info("[Handlers] Argument: " + query.data)
-    await query.answer()
     try:
-        response = resolve_sold(query.data)
+        async with chat_action(update, context):
+            response = await resolve_sold(callback_request(callback, mode="STOCK"))
         response = format_items_for_sale_response(response)
+    except QuotaExceeded as e:
+        logging.warning("[Handlers] " + str(e))
+        await respond_busy(update, context)
+        return
     except Exception as e:
         logging.error(e)
         # response = str(e)
     if response is None or len(response) == 0:
-        response = escape("Cannot find data for " + query.data)
+        response = escape("Cannot find data for " + callback.payload)
 
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=response, parse_mode='MarkdownV2')
+    await as_webhook_reply(context.bot.send_message(chat_id=update.effective_chat.id, text=response,
+                                                    parse_mode='MarkdownV2'))
 
 
-async def def_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@traced("handler")
+async def def_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, callback=None) -> None:
     logging.warning("[Handlers] Processing default button request")
     query = update.callback_query
     await query.answer(text="Not implemented yet")
 
 
+@traced("handler")
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # One handler for every button: the action code picks the callback straight from CALLBACK_ROUTES
+    callback = decode(update.callback_query.data)
+    if callback is None:
+        await def_button_handler(update, context)
+        return
+    if callback.action in SELF_ANSWERED_ACTIONS:
+        await CALLBACK_ROUTES[callback.action](update, context, callback)
+        return
+    # answered alongside the lookups, so the button stops spinning before they are done
+    answer = asyncio.ensure_future(update.callback_query.answer())
+    try:
+        await CALLBACK_ROUTES[callback.action](update, context, callback)
+    finally:
+        try:
+            await answer
+        except Exception as e:
+            logging.warning("[Handlers] Failed to answer callback query: " + str(e))
+
+
+def callback_request(callback, mode="stock") -> InfoRequest:
+    if callback.item_type is None:
+        # buttons sent before the compact encoding only carry the item number
+        info_request = resolve_request(callback.payload)
+    else:
+        info_request = InfoRequest(item_type=callback.item_type, item_number=callback.payload)
+    info_request.state = callback.condition or "N"
+    info_request.mode = mode
+    return info_request
+
+
 def resolve_item_info_keyboard(update: Update, item_number, item_type):
     if update.effective_chat.type == Chat.SUPERGROUP or update.effective_chat.type == Chat.GROUP:
         keyboard = [
-            [InlineKeyboardButton("More info on " + item_number, callback_data="more " + item_number)],
+            [InlineKeyboardButton("More info on " + item_number, callback_data=encode("more", item_number, item_type))],
             [InlineKeyboardButton("View on BL", url=BL_URL.format(item_type[0], item_number))]
         ]
     else:
         keyboard = [
-            [InlineKeyboardButton("Prices for new " + item_number, callback_data="PRICE NEW " + item_number),
-             InlineKeyboardButton("Prices for used " + item_number, callback_data="PRICE USED " + item_number)],
-            [InlineKeyboardButton("Recently sold new", callback_data="SOLD NEW " + item_number),
-             InlineKeyboardButton("Recently sold used", callback_data="SOLD USED " + item_number)],
-            [InlineKeyboardButton("For sale new", callback_data="STOCK NEW " + item_number),
-             InlineKeyboardButton("For sale used", callback_data="STOCK USED " + item_number)],
-            [InlineKeyboardButton("Minifigures of " + item_number, callback_data="SUBSET " + item_number) if item_type == "SET" else
-             InlineKeyboardButton("Sets containing " + item_number, callback_data="SUPERSET " + item_number)],
+            [InlineKeyboardButton("Prices for new " + item_number, callback_data=encode("PRICE", item_number, item_type, "N")),
+             InlineKeyboardButton("Prices for used " + item_number, callback_data=encode("PRICE", item_number, item_type, "U"))],
+            [InlineKeyboardButton("Recently sold new", callback_data=encode("SOLD", item_number, item_type, "N")),
+             InlineKeyboardButton("Recently sold used", callback_data=encode("SOLD", item_number, item_type, "U"))],
+            [InlineKeyboardButton("For sale new", callback_data=encode("STOCK", item_number, item_type, "N")),
+             InlineKeyboardButton("For sale used", callback_data=encode("STOCK", item_number, item_type, "U"))],
+            [InlineKeyboardButton("Minifigures of " + item_number, callback_data=encode("SUBSET", item_number, item_type)) if item_type == "SET" else
+             InlineKeyboardButton("Sets containing " + item_number, callback_data=encode("SUPERSET", item_number, item_type))],
             [InlineKeyboardButton("View on BL", url=BL_URL.format(item_type[0], item_number))]
         ]
 
     return keyboard
+
+
+CALLBACK_ROUTES = {
+    "INFO": info_button_handler,
+    "more": group_button_handler,
+    "PRICE": price_button_handler,
+    "SOLD": sold_button_handler,
+    "STOCK": stock_button_handler,
+    "SUBSET": subset_button_handler,
+    "SUPERSET": superset_button_handler,
+    "SETSEARCH": search_set_button_handler,
+    "MINIFIGSEARCH": search_minifigure_button_handler,
+    "VALUATION": valuation_button_handler
+}
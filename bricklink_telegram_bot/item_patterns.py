@@ -0,0 +1,4 @@
+# Item number patterns, kept free of imports so the catalog refresh function can use them without the bot's
+# BrickLink credentials
+SET_EXPR = "\\b[\\d]{2,7}(?:-\\d)?\\b"
+MINIFIG_EXPR = "\\b[a-z]{1,3}[\\d]{2,4}\\b"
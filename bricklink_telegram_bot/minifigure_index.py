@@ -0,0 +1,343 @@
+import bisect
+import csv
+import heapq
+import io
+import math
+import os
+import re
+import struct
+import sys
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+
+TOKEN_EXPR = re.compile(r"[^\W_]+")
+SEARCH_LIMIT = int(os.environ.get('MF_SEARCH_LIMIT', '20'))
+# Minimal trigram similarity for a vocabulary token to count as a misspelling of a query word
+FUZZY_THRESHOLD = float(os.environ.get('MF_FUZZY_THRESHOLD', '0.4'))
+FUZZY_CANDIDATES = 16
+BM25_K1 = 1.2
+BM25_B = 0.75
+EXACT_WEIGHT = 1.0
+PREFIX_WEIGHT = 0.9
+SUBSTRING_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.7
+
+# Compiled index artifact: an uncompressed preamble followed by a zlib-compressed body holding a sorted
+# token dictionary, delta + varint encoded posting lists and code/name/year string columns.
+ARTIFACT_MAGIC = b'BLMF'
+ARTIFACT_VERSION = 2
+ARTIFACT_PREAMBLE = struct.Struct('<4sHH')
+ARTIFACT_HEADER = struct.Struct('<II')
+ARTIFACT_SECTIONS = ('token_offsets', 'tokens', 'posting_offsets', 'postings', 'code_offsets', 'codes',
+                     'name_offsets', 'names', 'year_offsets', 'years', 'lengths', 'year_numbers')
+ARTIFACT_SECTION_TABLE = struct.Struct('<' + 'II' * len(ARTIFACT_SECTIONS))
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_EXPR.findall(text.lower())
+
+
+def trigrams(token: str) -> set:
+    padded = '$' + token + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def year_number(year) -> int:
+    year = str(year or '')
+    return int(year) if year.isdigit() else 0
+
+
+class BaseMinifigureIndex(ABC):
+    trigram_postings = None
+    average_length = None
+
+    @abstractmethod
+    def tokens(self) -> list:
+        pass
+
+    @abstractmethod
+    def posting_list(self, token_id: int) -> list:
+        pass
+
+    @abstractmethod
+    def row(self, row_id: int) -> dict:
+        pass
+
+    @abstractmethod
+    def doc_length(self, row_id: int) -> int:
+        pass
+
+    @abstractmethod
+    def year_number(self, row_id: int) -> int:
+        pass
+
+    def trigram_index(self) -> dict:
+        # Built over the vocabulary only, once per container
+        if self.trigram_postings is None:
+            postings = {}
+            for token_id, token in enumerate(self.tokens()):
+                for trigram in trigrams(token):
+                    postings.setdefault(trigram, []).append(token_id)
+            self.trigram_postings = postings
+        return self.trigram_postings
+
+    def match_tokens(self, word: str) -> dict:
+        tokens = self.tokens()
+        matches = {}
+        if len(word) < 3:
+            position = bisect.bisect_left(tokens, word)
+            while position < len(tokens) and tokens[position].startswith(word):
+                matches[position] = EXACT_WEIGHT if tokens[position] == word else PREFIX_WEIGHT
+                position += 1
+            return matches
+        index = self.trigram_index()
+        word_trigrams = trigrams(word)
+        # Tokens containing the word must contain every inner trigram of it
+        inner = sorted((index.get(word[i:i + 3], ()) for i in range(len(word) - 2)), key=len)
+        candidates = set(inner[0]).intersection(*inner[1:])
+        for token_id in candidates:
+            token = tokens[token_id]
+            if token == word:
+                matches[token_id] = EXACT_WEIGHT
+            elif token.startswith(word):
+                matches[token_id] = PREFIX_WEIGHT
+            elif word in token:
+                matches[token_id] = SUBSTRING_WEIGHT
+        shared = {}
+        for trigram in word_trigrams:
+            for token_id in index.get(trigram, ()):
+                shared[token_id] = shared.get(token_id, 0) + 1
+        similar = []
+        for token_id, count in shared.items():
+            if token_id in matches:
+                continue
+            similarity = 2.0 * count / (len(word_trigrams) + len(tokens[token_id]))
+            if similarity >= FUZZY_THRESHOLD:
+                similar.append((similarity, token_id))
+        for similarity, token_id in heapq.nlargest(FUZZY_CANDIDATES, similar):
+            matches[token_id] = FUZZY_WEIGHT * similarity
+        return matches
+
+    def word_scores(self, word: str) -> dict:
+        total = len(self)
+        scores = {}
+        for token_id, weight in self.match_tokens(word).items():
+            rows = self.posting_list(token_id)
+            idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+            score = weight * idf
+            for row_id in rows:
+                if scores.get(row_id, 0.0) < score:
+                    scores[row_id] = score
+        return scores
+
+    def search(self, search_str: str, limit=SEARCH_LIMIT) -> list:
+        words = sorted(set(tokenize(search_str)))
+        if not words or len(self) == 0:
+            return []
+        per_word = sorted((self.word_scores(word) for word in words), key=len)
+        if not per_word[0]:
+            return []
+        if self.average_length is None:
+            self.average_length = sum(self.doc_length(row_id) for row_id in range(len(self))) / len(self)
+        ranked = []
+        for row_id, score in per_word[0].items():
+            for scores in per_word[1:]:
+                if row_id not in scores:
+                    break
+                score += scores[row_id]
+            else:
+                # BM25 length normalization with a term frequency of one
+                norm = (BM25_K1 + 1) / (1 + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_length(row_id) / self.average_length))
+                ranked.append((score * norm, row_id))
+        top = heapq.nlargest(limit, ranked, key=lambda entry: (round(entry[0], 6), self.year_number(entry[1])))
+        return [self.row(row_id) for score, row_id in top]
+
+    def rows(self):
+        for row_id in range(len(self)):
+            yield self.row(row_id)
+
+
+class MinifigureIndex(BaseMinifigureIndex):
+    def __init__(self):
+        self.codes = []
+        self.names = []
+        self.years = []
+        self.postings = {}
+        self.lengths = []
+        self.vocabulary = []
+
+    @classmethod
+    def from_csv(cls, body: bytes):
+        index = cls()
+        for row in csv.DictReader(io.StringIO(body.decode('utf-8'))):
+            index.add(row['code'], row['name'], row['year'])
+        index.finalize()
+        return index
+
+    def add(self, code, name, year):
+        row_id = len(self.codes)
+        self.codes.append(code)
+        self.names.append(name)
+        self.years.append(year)
+        tokens = tokenize(name)
+        self.lengths.append(min(len(tokens), 255))
+        for token in set(tokens):
+            self.postings.setdefault(token, []).append(row_id)
+
+    def finalize(self):
+        self.vocabulary = sorted(self.postings)
+        self.trigram_postings = None
+        self.average_length = None
+
+    def tokens(self) -> list:
+        return self.vocabulary
+
+    def posting_list(self, token_id: int) -> list:
+        return self.postings[self.vocabulary[token_id]]
+
+    def doc_length(self, row_id: int) -> int:
+        return self.lengths[row_id]
+
+    def year_number(self, row_id: int) -> int:
+        return year_number(self.years[row_id])
+
+    def row(self, row_id: int) -> dict:
+        return {
+            'num': self.codes[row_id],
+            'name': self.names[row_id],
+            'year': self.years[row_id]
+        }
+
+    def __len__(self):
+        return len(self.codes)
+
+    def to_artifact(self) -> bytes:
+        token_offsets, tokens = pack_strings(self.vocabulary)
+        posting_offsets = array('I', [0])
+        postings = bytearray()
+        for token in self.vocabulary:
+            previous = 0
+            for row_id in self.postings[token]:
+                encode_varint(row_id - previous, postings)
+                previous = row_id
+            posting_offsets.append(len(postings))
+        code_offsets, codes = pack_strings(self.codes)
+        name_offsets, names = pack_strings(self.names)
+        year_offsets, years = pack_strings(str(year or '') for year in self.years)
+        lengths = array('B', self.lengths).tobytes()
+        year_numbers = array('H', (year_number(year) for year in self.years)).tobytes()
+        sections = [token_offsets, tokens, posting_offsets.tobytes(), bytes(postings), code_offsets, codes,
+                    name_offsets, names, year_offsets, years, lengths, year_numbers]
+
+        body = bytearray(ARTIFACT_HEADER.pack(len(self.codes), len(self.vocabulary)))
+        table_position = len(body)
+        body.extend(bytes(ARTIFACT_SECTION_TABLE.size))
+        table = []
+        for section in sections:
+            # keep every section 4-byte aligned so offset arrays can be cast in place
+            body.extend(bytes(-len(body) % 4))
+            table.extend((len(body), len(section)))
+            body.extend(section)
+        ARTIFACT_SECTION_TABLE.pack_into(body, table_position, *table)
+        return ARTIFACT_PREAMBLE.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, 0) + zlib.compress(bytes(body), 9)
+
+
+# Read-only index served straight from an artifact buffer: rows are only decoded for search results.
+class CompactMinifigureIndex(BaseMinifigureIndex):
+    def __init__(self, buffer):
+        if sys.byteorder != 'little':
+            raise IndexFormatError("Index artifacts can only be read on little-endian hosts")
+        self.buffer = memoryview(buffer)
+        self.row_count, self.token_count = ARTIFACT_HEADER.unpack_from(self.buffer, 0)
+        table = ARTIFACT_SECTION_TABLE.unpack_from(self.buffer, ARTIFACT_HEADER.size)
+        sections = {name: self.buffer[table[i * 2]:table[i * 2] + table[i * 2 + 1]]
+                    for i, name in enumerate(ARTIFACT_SECTIONS)}
+        self.token_offsets = sections['token_offsets'].cast('I')
+        self.token_blob = sections['tokens']
+        self.posting_offsets = sections['posting_offsets'].cast('I')
+        self.posting_blob = sections['postings']
+        self.columns = {
+            'num': (sections['code_offsets'].cast('I'), sections['codes']),
+            'name': (sections['name_offsets'].cast('I'), sections['names']),
+            'year': (sections['year_offsets'].cast('I'), sections['years'])
+        }
+        self.lengths = sections['lengths']
+        self.year_numbers = sections['year_numbers'].cast('H')
+        self.vocabulary = None
+
+    @classmethod
+    def from_artifact(cls, data: bytes):
+        if len(data) < ARTIFACT_PREAMBLE.size:
+            raise IndexFormatError("Index artifact is truncated")
+        magic, version, flags = ARTIFACT_PREAMBLE.unpack_from(data, 0)
+        if magic != ARTIFACT_MAGIC:
+            raise IndexFormatError("Not a minifigure index artifact")
+        if version != ARTIFACT_VERSION:
+            raise IndexFormatError("Unsupported index artifact version " + str(version))
+        return cls(zlib.decompress(memoryview(data)[ARTIFACT_PREAMBLE.size:]))
+
+    def tokens(self) -> list:
+        # Decoded once per container: the vocabulary is far smaller than the catalog itself
+        if self.vocabulary is None:
+            self.vocabulary = unpack_strings(self.token_offsets, self.token_blob)
+        return self.vocabulary
+
+    def posting_list(self, token_id: int) -> list:
+        return decode_varints(self.posting_blob[self.posting_offsets[token_id]:self.posting_offsets[token_id + 1]])
+
+    def row(self, row_id: int) -> dict:
+        return {name: bytes(blob[offsets[row_id]:offsets[row_id + 1]]).decode('utf-8')
+                for name, (offsets, blob) in self.columns.items()}
+
+    def doc_length(self, row_id: int) -> int:
+        return self.lengths[row_id]
+
+    def year_number(self, row_id: int) -> int:
+        return self.year_numbers[row_id]
+
+    def __len__(self):
+        return self.row_count
+
+
+def pack_strings(strings) -> tuple:
+    offsets = array('I', [0])
+    blob = bytearray()
+    for string in strings:
+        blob.extend(string.encode('utf-8'))
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+
+def unpack_strings(offsets, blob) -> list:
+    text = bytes(blob)
+    return [text[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data) -> list:
+    # posting lists are stored as gaps between ascending row ids
+    rows = []
+    row_id = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            row_id += value
+            rows.append(row_id)
+            value = 0
+            shift = 0
+    return rows
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+import tracing
+from s3_client import BUCKET, get_client
+
+BL_DAILY_QUOTA = int(os.environ.get('BL_DAILY_QUOTA', '5000'))
+BL_RATE_PER_SECOND = float(os.environ.get('BL_RATE_PER_SECOND', '5'))
+BL_BURST = int(os.environ.get('BL_BURST', '10'))
+QUOTA_STORE_ENABLED = os.environ.get('QUOTA_STORE_ENABLED', 'true').lower() == 'true'
+QUOTA_PREFIX = os.environ.get('QUOTA_PREFIX', 'quota/')
+# Every container adds its calls to the same daily object, so they are written in batches: once this many are
+# unrecorded or the oldest of them is this many seconds old
+QUOTA_FLUSH_CALLS = int(os.environ.get('QUOTA_FLUSH_CALLS', '50'))
+QUOTA_FLUSH_INTERVAL = float(os.environ.get('QUOTA_FLUSH_INTERVAL', '60'))
+
+INTERACTIVE = 0
+OPTIONAL = 1
+BACKGROUND = 2
+# Share of the daily quota that has to be left for a priority to still get requests through
+RESERVES = {
+    INTERACTIVE: 0.0,
+    OPTIONAL: float(os.environ.get('QUOTA_OPTIONAL_RESERVE', '0.1')),
+    BACKGROUND: float(os.environ.get('QUOTA_BACKGROUND_RESERVE', '0.25'))
+}
+# How long a caller may wait for a token before giving up
+MAX_WAIT = {
+    INTERACTIVE: 1.5,
+    OPTIONAL: 0.3,
+    BACKGROUND: 30.0
+}
+ITEM_URL_EXPR = re.compile(r"^items/([^/]+)/[^/]+")
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def endpoint_name(url: str) -> str:
+    return ITEM_URL_EXPR.sub(r"items/\1/{no}", url)
+
+
+def today() -> str:
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+class S3QuotaStore:
+    def __init__(self, bucket=BUCKET, prefix=QUOTA_PREFIX, s3=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3
+
+    def client(self):
+        if self.s3 is None:
+            self.s3 = get_client()
+        return self.s3
+
+    def load(self, day):
+        try:
+            with tracing.span('s3', 'quota/get'):
+                response = self.client().get_object(Bucket=self.bucket, Key=self.prefix + day + '.json')
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            return {'total': 0, 'endpoints': {}}, None
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def add(self, day, counts, attempts=3):
+        # Containers update the same daily object, so writes are conditional on the version that was read
+        for attempt in range(attempts):
+            usage, etag = self.load(day)
+            for endpoint, count in counts.items():
+                usage['endpoints'][endpoint] = usage['endpoints'].get(endpoint, 0) + count
+                usage['total'] += count
+            params = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                with tracing.span('s3', 'quota/put'):
+                    self.client().put_object(Bucket=self.bucket, Key=self.prefix + day + '.json',
+                                             Body=json.dumps(usage).encode('utf-8'),
+                                             ContentType='application/json', **params)
+                return usage
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict', '412'):
+                    raise
+                logging.debug("[Quota] Concurrent usage update, retrying")
+        raise Exception("Could not record BrickLink usage for " + day)
+
+
+class QuotaGovernor:
+    def __init__(self, daily_quota=BL_DAILY_QUOTA, rate=BL_RATE_PER_SECOND, burst=BL_BURST, store=None,
+                 flush_calls=QUOTA_FLUSH_CALLS, flush_interval=QUOTA_FLUSH_INTERVAL):
+        self.daily_quota = daily_quota
+        self.rate = rate
+        self.burst = burst
+        self.store = store
+        self.flush_calls = flush_calls
+        self.flush_interval = flush_interval
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.waiting = {priority: 0 for priority in RESERVES}
+        self.day = None
+        self.used = 0
+        self.unflushed = {}
+        self.unflushed_since = None
+
+    async def load(self):
+        day = today()
+        if self.day == day:
+            return
+        self.day = day
+        self.used = 0
+        self.unflushed = {}
+        self.unflushed_since = None
+        if self.store is not None:
+            try:
+                usage, etag = await asyncio.to_thread(self.store.load, day)
+                # calls made by other coroutines while loading are already counted
+                self.used += usage['total']
+            except Exception as e:
+                logging.error("[Quota] Failed to load usage for " + day)
+                logging.error(e)
+
+    def remaining(self) -> int:
+        return self.daily_quota - self.used
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    async def acquire(self, url, priority=INTERACTIVE):
+        await self.load()
+        if self.remaining() <= self.daily_quota * RESERVES[priority]:
+            raise QuotaExceeded("BrickLink quota reserved, " + str(self.remaining()) + " calls left today")
+        deadline = time.monotonic() + MAX_WAIT[priority]
+        while True:
+            self.refill()
+            ahead = sum(count for waiting, count in self.waiting.items() if waiting < priority)
+            if self.tokens >= 1 and ahead == 0:
+                self.tokens -= 1
+                break
+            delay = max((1 - self.tokens) / self.rate, 0.01)
+            if time.monotonic() + delay > deadline:
+                raise QuotaExceeded("BrickLink rate limit reached")
+            self.waiting[priority] += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.waiting[priority] -= 1
+        endpoint = endpoint_name(url)
+        self.used += 1
+        self.unflushed[endpoint] = self.unflushed.get(endpoint, 0) + 1
+        if self.unflushed_since is None:
+            self.unflushed_since = time.monotonic()
+
+    def flush_due(self) -> bool:
+        if self.store is None or not self.unflushed:
+            return False
+        return sum(self.unflushed.values()) >= self.flush_calls \
+            or time.monotonic() - self.unflushed_since >= self.flush_interval
+
+    async def flush(self, force=False):
+        if self.store is None or not self.unflushed or not (force or self.flush_due()):
+            return
+        day = self.day
+        counts, self.unflushed = self.unflushed, {}
+        since, self.unflushed_since = self.unflushed_since, None
+        try:
+            usage = await asyncio.to_thread(self.store.add, day, counts)
+            self.used = max(self.used, usage['total'])
+            logging.debug("[Quota] BrickLink usage today: " + str(usage['total']) + " of " + str(self.daily_quota))
+        except Exception as e:
+            logging.error("[Quota] Failed to record BrickLink usage")
+            logging.error(e)
+            if self.day == day:
+                # kept for the next flush, e.g. after losing a burst of concurrent writes from other containers
+                for endpoint, count in counts.items():
+                    self.unflushed[endpoint] = self.unflushed.get(endpoint, 0) + count
+                self.unflushed_since = since
+
+    def stats(self) -> dict:
+        return {
+            'day': self.day,
+            'used': self.used,
+            'remaining': self.remaining(),
+            'unflushed': dict(self.unflushed)
+        }
+
+
+governor = QuotaGovernor(store=S3QuotaStore() if QUOTA_STORE_ENABLED else None)
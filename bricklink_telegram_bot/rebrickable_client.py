@@ -1,23 +1,126 @@
+import asyncio
 import logging
 import os
-import requests
+import re
+
+import httpx
+
+import tracing
+from cache import ResponseCache, TieredCache, MISSING, shared_tier
+from item_patterns import SET_EXPR
+from singleflight import SingleFlight, request_key
 
 REBRICKABLE_KEY = os.environ['REBRICKABLE_KEY']
+REBRICKABLE_CACHE_TTL = int(os.environ.get('REBRICKABLE_CACHE_TTL', str(24 * 60 * 60)))
+REBRICKABLE_TIMEOUT = float(os.environ.get('REBRICKABLE_TIMEOUT', '2.5'))
+REBRICKABLE_RETRIES = int(os.environ.get('REBRICKABLE_RETRIES', '2'))
+REBRICKABLE_PAGE_SIZE = int(os.environ.get('REBRICKABLE_PAGE_SIZE', '50'))
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+SEARCH_LIMIT = 20
 BASE_URL = 'https://rebrickable.com/api/v3'
 
+cache = TieredCache(ResponseCache(), shared_tier)
+
+
+class RebrickableError(Exception):
+    pass
+
+
+class ApiClient:
+    def __init__(self, timeout=REBRICKABLE_TIMEOUT, retries=REBRICKABLE_RETRIES):
+        self.timeout = timeout
+        self.retries = retries
+        self.inflight = SingleFlight()
+        self.session = None
+
+    def get_session(self) -> httpx.AsyncClient:
+        if self.session is None or self.session.is_closed:
+            logging.debug("[RebrickableClient] Creating session")
+            self.session = httpx.AsyncClient(base_url=BASE_URL, timeout=self.timeout,
+                                             headers={"Authorization": "key " + REBRICKABLE_KEY})
+        return self.session
+
+    async def get(self, url, params=None):
+        return await self.inflight.do(request_key('GET', url, params), lambda: self.send(url, params))
+
+    async def send(self, url, params=None):
+        for attempt in range(self.retries + 1):
+            delay = RETRY_BACKOFF * 2 ** attempt
+            try:
+                with tracing.span('rebrickable', url.strip('/')) as call:
+                    response = await self.get_session().get(url, params=params)
+                    call.bytes = len(response.content)
+                    if response.status_code != 200:
+                        call.status = str(response.status_code)
+            except httpx.TransportError as e:
+                logging.warning("[RebrickableClient] Request failed: " + repr(e))
+                error = RebrickableError(repr(e))
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                logging.error("[RebrickableClient] Rebrickable returned error code " + str(response.status_code))
+                logging.error(response.text)
+                error = RebrickableError("Rebrickable returned error code " + str(response.status_code))
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+                if response.headers.get('Retry-After', '').isdigit():
+                    delay = max(delay, float(response.headers['Retry-After']))
+            if attempt < self.retries and delay <= self.timeout:
+                await asyncio.sleep(delay)
+            else:
+                raise error
+
+    async def close(self):
+        if self.session is not None and not self.session.is_closed:
+            await self.session.aclose()
+        self.session = None
+
+
+client = ApiClient()
+
+
+def normalize_query(search_str: str) -> str:
+    return " ".join(search_str.lower().split())
+
+
+async def fetch_set_search_page(search_str: str, page: int):
+    query = normalize_query(search_str)
+    key = "rebrickable/lego/sets/?search=" + query + "&page=" + str(page)
+    with tracing.span('cache', 'rebrickable/lego/sets') as lookup:
+        response = await cache.get(key, REBRICKABLE_CACHE_TTL)
+        if response is not MISSING:
+            logging.debug("[RebrickableClient] Cache hit for " + key)
+            lookup.cache = 'hit'
+            return response
+        lookup.cache = 'miss'
+        # newest sets first, so the first pages already hold what the result keyboard shows
+        response = await client.get("/lego/sets/", params={
+            "search": query,
+            "ordering": "-year",
+            "page": page,
+            "page_size": REBRICKABLE_PAGE_SIZE
+        })
+    cache.set(key, response, REBRICKABLE_CACHE_TTL)
+    return response
+
+
+async def iter_set_search(search_str: str):
+    page = 1
+    while True:
+        response = await fetch_set_search_page(search_str, page)
+        for item in response["results"]:
+            yield item
+        if not response.get("next"):
+            return
+        page += 1
 
-def set_search_request(search_str: str):
-    url = BASE_URL + "/lego/sets/"
-    headers = {
-        "Authorization": "key " + REBRICKABLE_KEY
-    }
-    params = {
-        "search": search_str
-    }
-    response = requests.get(url=url, headers=headers, params=params)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        logging.error("[RebrickableClient] Rebrickable returned error code " + str(response.status_code))
-        logging.error(response.text)
 
+async def set_search_request(search_str: str, limit=SEARCH_LIMIT):
+    results = []
+    async for item in iter_set_search(search_str):
+        if re.search(SET_EXPR, item["set_num"]):
+            results.append(item)
+            if len(results) >= limit:
+                break
+    return {"results": results}
@@ -0,0 +1,105 @@
+import functools
+import itertools
+
+# Characters escaped in MarkdownV2 replies. Escaping is per character, so escape(a + b) == escape(a) + escape(b)
+# and every card is escaped once, as a whole.
+MARKDOWN_SPECIAL = "-![](){}._*`&<>#="
+# str.replace calls beat a str.translate table here by about 7x: the mapping is one to two characters and replies
+# carry emoji, which both put translate on its slow path
+ESCAPES = tuple((char, "\\" + char) for char in MARKDOWN_SPECIAL)
+HTML_ENTITIES = (
+    ("&#40;", "("),
+    ("&#41;", ")"),
+    ("&lt;", "<"),
+    ("&gt;", ">"),
+    ("&#39;", "'"),
+    # this has to be last:
+    ("&amp;", "&")
+)
+ASCII_LOWER = "abcdefghijklmnopqrstuvwxyz0123456789"
+OFFSET = ord("🇦") - ord("A")
+DETAIL_LIMIT = 20
+AVAILABLE = u"\u2705"
+UNAVAILABLE = u"\u274C"
+
+
+def escape(s: str) -> str:
+    for char, escaped in ESCAPES:
+        if char in s:
+            s = s.replace(char, escaped)
+    return s
+
+
+def unescape_html(s: str) -> str:
+    for entity, char in HTML_ENTITIES:
+        s = s.replace(entity, char)
+    return s
+
+
+def format_price(price_str: str):
+    return str(round(float(price_str), 2))
+
+
+def get_currency_symbol(currency_code) -> str:
+    match currency_code:
+        case "UAH":
+            return '₴'
+        case "EUR":
+            return '€'
+        case "USD":
+            return '$'
+        case _:
+            return currency_code
+
+
+@functools.lru_cache(maxsize=256)
+def resolve_flag_emoji(countrycode: str) -> str:
+    if countrycode == "UK":
+        return u"\U0001F1EC\U0001F1E7"
+    elif countrycode == "RU":
+        return u"\U0001F4A9"
+    code = [c for c in countrycode.lower() if c in ASCII_LOWER]
+    return "".join([chr(ord(c.upper()) + OFFSET) for c in code])
+
+
+# Cards are f-strings, compiled once with the module and filled with raw values; callers escape the result.
+
+def info_card(message: dict) -> str:
+    return (f"\U0001F170\uFE0F Name: {unescape_html(message['name'])}\n"
+            f"\U0001F5BC Image: {message['image_url']}\n"
+            f"\U0001F4C6 Year released: {message['year_released']}\n"
+            f"\u2693\uFE0F Weight: {message['weight']}g\n")
+
+
+def price_card(message: dict) -> str:
+    currency = get_currency_symbol(message["currency_code"])
+    return (f"Price for {message['item']['no']} ({message['new_or_used']})\n"
+            f"\U0001F4C9 Minimal price: {format_price(message['min_price'])}{currency}\n"
+            f"\U0001F4C8 Maximal price: {format_price(message['max_price'])}{currency}\n"
+            f"\U0001F4CA Median price: {format_price(message['avg_price'])}{currency}\n"
+            f"\U0001F522 Quantity for sale: {message['total_quantity']}")
+
+
+def sold_card(message: dict) -> str:
+    if len(message["price_detail"]) == 0:
+        return f"Seems like no {message['item']['no']} were sold recently \U0001F914"
+    currency = get_currency_symbol(message["currency_code"])
+    lines = [f"Recently sold {message['item']['no']} ({message['new_or_used']}):"]
+    lines.extend(f"\nSeller: {resolve_flag_emoji(item['seller_country_code'])}, "
+                 f"Buyer: {resolve_flag_emoji(item['buyer_country_code'])}, "
+                 f"Price: {format_price(item['unit_price'])} {currency}, Quantity: {item['quantity']}"
+                 for item in itertools.islice(message["price_detail"], DETAIL_LIMIT))
+    return "".join(lines)
+
+
+def stock_card(message: dict) -> str:
+    if len(message["price_detail"]) == 0:
+        return f"Seems like {message['item']['no']} is out of stock \U0001F914"
+    currency = get_currency_symbol(message["currency_code"])
+    ships_to = resolve_flag_emoji("ua")
+    lines = [f"{message['item']['no']} for sale ({message['new_or_used']}):"]
+    lines.extend(f"\n\U0001F4B5 Price: {format_price(item['unit_price'])}{currency}, "
+                 f"\U0001F522 Quantity: {item['quantity']}, "
+                 f"\U0001F69A Ships to {ships_to}: {AVAILABLE if item['shipping_available'] else UNAVAILABLE}"
+                 for item in itertools.islice(message["price_detail"], DETAIL_LIMIT))
+    return "".join(lines)
@@ -1,15 +1,24 @@
+import asyncio
+import os
 import re
 import logging
 
-from bricklink_client import ApiClient
+import tracing
+from bricklink_client import ApiClient, NotFoundError
+from quota import QuotaExceeded, INTERACTIVE, OPTIONAL, endpoint_name
+from item_patterns import SET_EXPR, MINIFIG_EXPR
+from cache import ResponseCache, TieredCache, MISSING, CATALOG_TTL, PRICE_GUIDE_TTL, NEGATIVE_TTL, cache_key, \
+    shared_tier
 
-SET_EXPR = "\\b[\\d]{2,7}(?:-\\d)?\\b"
-MINIFIG_EXPR = "\\b[a-z]{1,3}[\\d]{2,4}\\b"
 USED_EXPR = "\\bUSED\\b"
 NEW_EXPR = "\\bNEW\\b"
 STOCK_EXPR = "\\bSTOCK\\b"
 SOLD_EXPR = "\\bSOLD\\b"
+ITEMS_EXPR = re.compile("(?P<set>" + SET_EXPR + ")|(?P<minifig>" + MINIFIG_EXPR + ")")
+PRICE_BATCH_LIMIT = int(os.environ.get('PRICE_BATCH_LIMIT', '30'))
+PRICE_BATCH_CONCURRENCY = int(os.environ.get('PRICE_BATCH_CONCURRENCY', '5'))
 client = ApiClient()
+cache = TieredCache(ResponseCache(), shared_tier)
 
 
 class InfoRequest:
@@ -38,6 +47,37 @@ def resolve_request(message) -> InfoRequest:
             logging.error('[RequestMatchers] Could not resolve request: ' + message)
             raise Exception('Could not match request: ' + message)
     request = InfoRequest(item_type=itemType, item_number=itemNum)
+    return apply_modifiers(request, message)
+
+
+def as_request(message) -> InfoRequest:
+    # resolvers take either free text or a request already decoded from a button
+    if isinstance(message, InfoRequest):
+        return message
+    return resolve_request(message)
+
+
+def resolve_requests(message) -> list:
+    # every set and minifigure number in the message, in order and without repeats, found in a single pass
+    requests = []
+    seen = set()
+    for match in ITEMS_EXPR.finditer(message):
+        if match.group('set'):
+            itemType = "SET"
+            itemNum = match.group('set') if match.group('set').find("-") != -1 else match.group('set') + "-1"
+        else:
+            itemType = "MINIFIG"
+            itemNum = match.group('minifig')
+        if itemNum in seen:
+            continue
+        seen.add(itemNum)
+        requests.append(apply_modifiers(InfoRequest(item_type=itemType, item_number=itemNum), message))
+        if len(requests) >= PRICE_BATCH_LIMIT:
+            break
+    return requests
+
+
+def apply_modifiers(request, message) -> InfoRequest:
     state = match_regexp(message, NEW_EXPR)
     if not state:
         state = match_regexp(message, USED_EXPR)
@@ -57,65 +97,113 @@ def resolve_request(message) -> InfoRequest:
     return request
 
 
-def resolve_info(message) -> dict:
-    info_request = resolve_request(message)
+async def resolve_info(message) -> dict:
+    info_request = as_request(message)
     url = "items/" + info_request.itemType + "/" + info_request.itemNumber
-    response = client.get(url=url)
+    response = await cached_get(url=url, ttl=CATALOG_TTL)
     return response
 
 
-def resolve_subsets(message) -> []:
-    info_request = resolve_request(message)
+async def resolve_subsets(message) -> []:
+    info_request = as_request(message)
     url = "items/" + info_request.itemType + "/" + info_request.itemNumber + "/subsets"
-    response = client.get(url=url)
+    response = await cached_get(url=url, ttl=CATALOG_TTL)
     return response
 
 
-def resolve_supersets(message) -> []:
-    info_request = resolve_request(message)
+async def resolve_supersets(message) -> []:
+    info_request = as_request(message)
     url = "items/" + info_request.itemType + "/" + info_request.itemNumber + "/supersets"
-    response = client.get(url=url)
+    response = await cached_get(url=url, ttl=CATALOG_TTL)
     return response
 
 
 
-def resolve_price(message):
-    info_request = resolve_request(message)
+async def resolve_price(message):
+    return await resolve_price_guide(as_request(message))
+
+
+async def resolve_prices(message, concurrency=PRICE_BATCH_CONCURRENCY) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_one(info_request):
+        async with semaphore:
+            try:
+                return info_request, await resolve_price_guide(info_request)
+            except Exception as e:
+                logging.error("[RequestMatchers] Price lookup failed for " + info_request.itemNumber)
+                logging.error(e)
+                return info_request, None
+
+    return await asyncio.gather(*(resolve_one(info_request) for info_request in resolve_requests(message)))
+
+
+async def resolve_price_guide(info_request):
     url = "items/" + info_request.itemType + "/" + info_request.itemNumber + "/price"
     logging.debug("[RequestMatchers] Requesting URL: " + url)
-    response = client.get(url=url, params={
+    response = await cached_get(url=url, params={
         "guide_type": info_request.mode,
         "new_or_used": info_request.state,
         "currency_code": info_request.currency_code
-    })
+    }, ttl=PRICE_GUIDE_TTL)
     return response
 
 
-def resolve_availability(item_type, item_num):
-    new_count = resolve_availability_by_cond_count(item_type, item_num, "N")
-    used_count = resolve_availability_by_cond_count(item_type, item_num, "U")
+async def resolve_availability(item_type, item_num):
+    try:
+        new_count, used_count = await asyncio.gather(resolve_availability_by_cond_count(item_type, item_num, "N"),
+                                                     resolve_availability_by_cond_count(item_type, item_num, "U"))
+    except QuotaExceeded as e:
+        # the availability section is the first thing dropped when the BrickLink budget runs low
+        logging.warning("[RequestMatchers] Skipping availability: " + str(e))
+        return None
     return new_count + used_count > 0
 
 
-def resolve_availability_by_cond_count(itemType, itemNum, condition):
+async def resolve_availability_by_cond_count(itemType, itemNum, condition):
     url = "items/" + itemType + "/" + itemNum + "/price"
     logging.debug("[RequestMatchers] Requesting URL: " + url)
-    response = client.get(url=url, params={
+    response = await cached_get(url=url, params={
         "country_code": "UA",
         "guide_type": "STOCK",
         "new_or_used": condition
-    })
+    }, ttl=PRICE_GUIDE_TTL, priority=OPTIONAL)
+    if not response:
+        return 0
     return len(response["price_detail"])
 
 
-def resolve_sold(message):
-    info_request = resolve_request(message)
+async def resolve_sold(message):
+    info_request = as_request(message)
     url = "items/" + info_request.itemType + "/" + info_request.itemNumber + "/price"
-    response = client.get(url=url, params={
+    response = await cached_get(url=url, params={
         "guide_type": info_request.mode,
         "new_or_used": info_request.state,
         "currency_code": info_request.currency_code
-    })
+    }, ttl=PRICE_GUIDE_TTL)
+    return response
+
+
+async def cached_get(url, params=None, ttl=CATALOG_TTL, priority=INTERACTIVE):
+    key = cache_key(url, params)
+    with tracing.span('cache', endpoint_name(url)) as lookup:
+        response = await cache.get(key, ttl)
+        if response is not MISSING:
+            logging.debug("[RequestMatchers] Cache hit for " + key)
+            lookup.cache = 'hit'
+            return response
+        logging.debug("[RequestMatchers] Cache miss for " + key)
+        lookup.cache = 'miss'
+        try:
+            response = await client.get(url=url, params=params, priority=priority)
+        except NotFoundError as e:
+            # Unknown items are remembered for a short while so repeated typos don't spend API quota
+            logging.info("[RequestMatchers] Not found: " + str(e))
+            cache.set(key, [], NEGATIVE_TTL)
+            lookup.status = 'not_found'
+            return []
+    if response:
+        cache.set(key, response, ttl)
     return response
 
 
@@ -4,111 +4,51 @@ import re
 
 from telegram import InlineKeyboardButton
 
-from request_matcher import SET_EXPR, resolve_availability
+from callbacks import encode
+from item_patterns import SET_EXPR
+from rendering import escape, unescape_html, format_price, get_currency_symbol, resolve_flag_emoji, info_card, \
+    price_card, sold_card, stock_card
 
-ASCII_LOWER = "abcdefghijklmnopqrstuvwxyz0123456789"
-OFFSET = ord("🇦") - ord("A")
 
-
-def format_info_response(message_dict: dict) -> str:
+def format_info_response(message_dict: dict, available) -> str:
     logging.debug("[Response formatter] format info response for: " + str(message_dict))
-    raw = (u"\U0001F170\uFE0F Name: " + unescape_html(message_dict["name"]) + "\n" \
-                                                                             "\U0001F5BC Image: " + message_dict[
-              "image_url"] + "\n"
-                             "\U0001F4C6 Year released: " + str(message_dict["year_released"]) + "\n"
-                                                                                                 "\u2693\uFE0F Weight: "
-           + str(message_dict["weight"]) + "g\n") \
-        # "\U0001F4D0 Dimensions: " + str(message["dim_x"]) + " x " + str(message["dim_y"]) + " x " + str(message[
-    # "dim_z"]) + "\n"
-    return escape(raw) + resolve_availability_section(message_dict)
+    return escape(info_card(message_dict)) + resolve_availability_section(message_dict, available)
 
 
 def format_price_response(message: dict) -> str:
-    res = (u"Price for " + message["item"]["no"] + " (" + message[
-        "new_or_used"] + ")" + "\n" + "\U0001F4C9 Minimal price: " + format_price(
-        message["min_price"]) + get_currency_symbol(
-        message["currency_code"]) + "\n" + u"\U0001F4C8 Maximal price: " + format_price(
-        message["max_price"]) + get_currency_symbol(message["currency_code"]) + "\n" +
-           "\U0001F4CA Median price: " + format_price(
-                message["avg_price"]) + get_currency_symbol(
-                message["currency_code"]) + "\n" + "\U0001F522 Quantity for sale: " + str(
-                message["total_quantity"]))
-    return escape(res)
-
-
-def get_currency_symbol(currency_code) -> str:
-    match currency_code:
-        case "UAH":
-            return '₴'
-        case "EUR":
-            return '€'
-        case "USD":
-            return '$'
-        case _:
-            return currency_code
+    return escape(price_card(message))
+
+
+def format_price_table_response(results: list) -> str:
+    # one monospace table for a batch of items; inside a pre block only ` and \ need escaping
+    condition = {"N": "new", "U": "used"}.get(results[0][0].state, results[0][0].state)
+    rows = [("Item", "Min", "Avg", "Max", "Qty")]
+    currency = ""
+    for info_request, message in results:
+        if message and "min_price" in message:
+            currency = get_currency_symbol(message["currency_code"])
+            rows.append((info_request.itemNumber, format_price(message["min_price"]), format_price(message["avg_price"]),
+                         format_price(message["max_price"]), str(message["total_quantity"])))
+        else:
+            rows.append((info_request.itemNumber, "n/a", "", "", ""))
+    widths = [max(len(row[i]) for row in rows) for i in range(5)]
+    lines = [row[0].ljust(widths[0]) + "".join("  " + value.rjust(widths[i + 1]) for i, value in enumerate(row[1:]))
+             for row in rows]
+    table = "\n".join(line.rstrip() for line in lines).replace("\\", "\\\\").replace("`", "\\`")
+    return escape("Prices (" + condition + ") " + currency + ":") + "\n```\n" + table + "\n```"
 
 
 def format_items_sold_response(message: dict) -> str:
-    if len(message["price_detail"]) > 0:
-        res = u"Recently sold " + message["item"]["no"] + " (" + message["new_or_used"] + "):"
-        for item in itertools.islice(message["price_detail"], 20):
-            res += "\nSeller: " + resolve_flag_emoji(item["seller_country_code"]) + \
-                   ", Buyer: " + resolve_flag_emoji(item["buyer_country_code"]) + \
-                   ", Price: " + format_price(item["unit_price"]) + " " + get_currency_symbol(message["currency_code"]) + \
-                   ", Quantity: " + str(item["quantity"])
-    else:
-        res = "Seems like no " + message["item"]["no"] + " were sold recently \U0001F914"
-    return escape(res)
+    return escape(sold_card(message))
 
 
 def format_items_for_sale_response(message: dict) -> str:
-    if len(message["price_detail"]) > 0:
-        res = message["item"]["no"] + " for sale (" + message["new_or_used"] + "):"
-        for item in itertools.islice(message["price_detail"], 20):
-            res += u"\n\U0001F4B5 Price: " + format_price(item["unit_price"]) + get_currency_symbol(
-                message["currency_code"]) + \
-                   ", \U0001F522 Quantity: " + str(item["quantity"]) + \
-                   ", \U0001F69A Ships to " + resolve_flag_emoji("ua") + ": " + \
-                   (u"\u2705" if item["shipping_available"] else u"\u274C")
-    else:
-        res = "Seems like " + message["item"]["no"] + " is out of stock \U0001F914"
-    return escape(res)
-
-
-def unescape_html(s: str) -> str:
-    s = s.replace("&#40;", "(")
-    s = s.replace("&#41;", ")")
-    s = s.replace("&lt;", "<")
-    s = s.replace("&gt;", ">")
-    s = s.replace("&#39;", "'")
-    # this has to be last:
-    s = s.replace("&amp;", "&")
-    return s
-
-
-def escape(s: str) -> str:
-    s = s.replace("-", "\\-")
-    s = s.replace("!", "\\!")
-    s = s.replace("[", "\\[")
-    s = s.replace("]", "\\]")
-    s = s.replace("(", "\\(")
-    s = s.replace(")", "\\)")
-    s = s.replace("{", "\\{")
-    s = s.replace("}", "\\}")
-    s = s.replace(".", "\\.")
-    s = s.replace("_", "\\_")
-    s = s.replace("*", "\\*")
-    s = s.replace("`", "\\`")
-    s = s.replace("&", "\\&")
-    s = s.replace("<", "\\<")
-    s = s.replace(">", "\\>")
-    s = s.replace("#", "\\#")
-    s = s.replace("=", "\\=")
-    return s
-
-
-def resolve_availability_section(message):
-    available = resolve_availability(message['type'], message["no"])
+    return escape(stock_card(message))
+
+
+def resolve_availability_section(message, available):
+    if available is None:
+        return ""
     if available:
         item_type = 'M' if message['type'] == 'MINIFIG' else 'S'
         return u"\u2705 Available in " + resolve_flag_emoji("ua") + ": " + \
@@ -119,23 +59,14 @@ def resolve_availability_section(message):
         return u"\u274C Not available in " + resolve_flag_emoji("ua")
 
 
-def resolve_flag_emoji(countrycode: str) -> str:
-    if countrycode == "UK":
-        return u"\U0001F1EC\U0001F1E7"
-    elif countrycode == "RU":
-        return u"\U0001F4A9"
-    code = [c for c in countrycode.lower() if c in ASCII_LOWER]
-    return "".join([chr(ord(c.upper()) + OFFSET) for c in code])
-
-
 def search_response_formatter(query_text: str):
     keyboard = [[
         InlineKeyboardButton(
             "Search Set '" + query_text + "'",
-            callback_data="SETSEARCH" + " " + query_text)], [
+            callback_data=encode("SETSEARCH", query_text))], [
         InlineKeyboardButton(
             "Search Minifigure '" + query_text + "'",
-            callback_data="MINIFIGSEARCH" + " " + query_text)]]
+            callback_data=encode("MINIFIGSEARCH", query_text))]]
     return keyboard
 
 
@@ -154,7 +85,7 @@ def subset_response_formatter(subset_response, target: str):
                 InlineKeyboardButton(
                     item["item"]["no"] + " - " + unescape_html(item["item"]["name"]) + " (" + str(
                         item["quantity"]) + ")",
-                    callback_data=target + " " + item["item"]["no"])])
+                    callback_data=encode(target, item["item"]["no"], "MINIFIG"))])
     return keyboard
 
 
@@ -172,7 +103,7 @@ def superset_response_formatter(subset_response, target: str):
                 InlineKeyboardButton(
                     item["item"]["no"] + " - " + unescape_html(item["item"]["name"]) + " (" + str(
                         item["quantity"]) + ")",
-                    callback_data=target + " " + item["item"]["no"])])
+                    callback_data=encode(target, item["item"]["no"], "SET"))])
     return keyboard
 
 
@@ -185,21 +116,17 @@ def set_search_response_formatter(message: dict, target: str):
             keyboard.append([
                 InlineKeyboardButton(
                     item["set_num"] + " - " + unescape_html(item["name"]) + " (" + str(item["year"]) + ")",
-                    callback_data=target + " " + item["set_num"])])
+                    callback_data=encode(target, item["set_num"], "SET"))])
     return keyboard
 
 
 def fig_search_response_formatter(minifigs: dict, target: str):
     keyboard = []
     if len(minifigs) > 0:
-        sets = sorted(minifigs, key=lambda k: k['year'], reverse=True)
-        for item in itertools.islice(sets, 20):
+        # results arrive ranked by relevance
+        for item in itertools.islice(minifigs, 20):
             keyboard.append([
                 InlineKeyboardButton(
                     item['num'] + " - " + unescape_html(item['name'] + " (" + str(item["year"]) + ")"),
-                    callback_data=target + " " + item['num'])])
+                    callback_data=encode(target, item['num'], "MINIFIG"))])
     return keyboard
-
-
-def format_price(price_str: str):
-    return str(round(float(price_str), 2))
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import logging
+import os
+from collections import deque
+
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+import rebrickable_client
+import tracing
+from app import TOKEN, register_handlers, chat_key, run_once, flush
+from request_matcher import client
+
+# Long-running alternative to app.lambda_handler for a single host: the same handlers, fed by long polling or by
+# a webhook server, with many updates in flight at once. Run with `python runtime.py polling` or
+# `python runtime.py webhook` (the latter needs python-telegram-bot[webhooks]).
+RUNTIME_CONCURRENCY = int(os.environ.get('RUNTIME_CONCURRENCY', '32'))
+RUNTIME_FLUSH_INTERVAL = float(os.environ.get('RUNTIME_FLUSH_INTERVAL', '30'))
+RUNTIME_DROP_PENDING = os.environ.get('RUNTIME_DROP_PENDING', 'false').lower() == 'true'
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+flush_task = None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Updates of different chats run concurrently; updates of one chat run one after another, in arrival order.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            # claimed in the chat's turn, so a slow claim can not let a later update of the chat overtake it
+            coroutine = run_once(update.update_id, coroutine)
+        key = chat_key(update)
+        if key is None:
+            await run_update(coroutine)
+            return
+        queue = self.queues.get(key)
+        if queue is not None:
+            # the task already serving this chat runs it next, so a busy chat never holds more than one slot
+            queue.append(coroutine)
+            return
+        queue = self.queues[key] = deque()
+        try:
+            await run_update(coroutine)
+            while queue:
+                await run_update(queue.popleft())
+        finally:
+            del self.queues[key]
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def run_update(coroutine):
+    try:
+        await coroutine
+    except Exception as e:
+        logging.error("[Runtime] Update failed")
+        logging.error(e)
+
+
+async def flush_periodically():
+    # The Lambda handler flushes after every update; here usage and cache writes are batched on a timer
+    while True:
+        await asyncio.sleep(RUNTIME_FLUSH_INTERVAL)
+        try:
+            await flush(force=True)
+        except Exception as e:
+            logging.error("[Runtime] Flush failed")
+            logging.error(e)
+
+
+async def post_init(application: Application):
+    global flush_task
+    flush_task = asyncio.create_task(flush_periodically())
+    logging.info("[Runtime] Processing up to " + str(application.update_processor.max_concurrent_updates)
+                 + " updates at once")
+
+
+async def post_stop(application: Application):
+    # runs once every update in flight has been processed
+    if flush_task is not None:
+        flush_task.cancel()
+        await asyncio.gather(flush_task, return_exceptions=True)
+    await flush(force=True)
+
+
+async def post_shutdown(application: Application):
+    await client.close()
+    await rebrickable_client.client.close()
+
+
+def build_application(concurrency=RUNTIME_CONCURRENCY) -> Application:
+    builder = Application.builder().token(token=TOKEN) \
+        .concurrent_updates(ChatOrderedUpdateProcessor(concurrency)) \
+        .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if tracing.TRACING_ENABLED:
+        builder = builder.request(tracing.TracedRequest(connection_pool_size=256))
+    dispatcher = builder.build()
+    register_handlers(dispatcher)
+    return dispatcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as a long-running process")
+    parser.add_argument('mode', choices=('polling', 'webhook'))
+    parser.add_argument('--concurrency', type=int, default=RUNTIME_CONCURRENCY,
+                        help="updates processed at once; one chat's updates always run in order")
+    parser.add_argument('--listen', default=WEBHOOK_LISTEN)
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--path', default=WEBHOOK_PATH, help="URL path the webhook server answers on")
+    parser.add_argument('--url', default=WEBHOOK_URL, help="public webhook URL registered with Telegram")
+    arguments = parser.parse_args()
+
+    application = build_application(arguments.concurrency)
+    # SIGINT and SIGTERM stop fetching, let the updates in flight finish and then shut down
+    if arguments.mode == 'polling':
+        # Telegram only delivers to one consumer: starting to poll removes the webhook the Lambda function uses
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=RUNTIME_DROP_PENDING)
+    else:
+        if not arguments.url:
+            parser.error("webhook mode needs --url or WEBHOOK_URL")
+        application.run_webhook(listen=arguments.listen, port=arguments.port, url_path=arguments.path,
+                                webhook_url=arguments.url, secret_token=WEBHOOK_SECRET,
+                                allowed_updates=Update.ALL_TYPES, drop_pending_updates=RUNTIME_DROP_PENDING)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,44 +2,54 @@ import csv
 import io
 import logging
 import os
+import tempfile
+import time
 
+from botocore.exceptions import ClientError
 
-import boto3
-from botocore.config import Config
+import tracing
+from minifigure_index import BaseMinifigureIndex, MinifigureIndex, CompactMinifigureIndex, IndexFormatError, \
+    ARTIFACT_VERSION
 
 REGION = os.environ['AWS_REGION']
 
 BUCKET = os.environ['BUCKET']
 MINIFIGURE_FILE_NAME = os.environ['MF_FILE']
+MINIFIGURE_INDEX_FILE_NAME = os.environ.get('MF_INDEX_FILE', MINIFIGURE_FILE_NAME + '.idx')
+MF_INDEX_REFRESH_INTERVAL = int(os.environ.get('MF_INDEX_REFRESH_INTERVAL', '300'))
+CSV_SPOOL_SIZE = int(os.environ.get('CSV_SPOOL_SIZE', str(1024 * 1024)))
 
 LEFT_BRACKET = '&#40;'
 RIGHT_BRACKET = '&#41;'
 
+s3 = None
+minifigure_index = None
+minifigure_key = None
+minifigure_etag = None
+minifigure_checked_at = 0.0
+
+
+def get_client():
+    global s3
+    if s3 is None:
+        # boto3 is most of the import time of the bot, so it is loaded with the first S3 call instead of on cold start
+        import boto3
+        from botocore.config import Config
+        config = Config(
+            retries={
+                'max_attempts': 0,
+                'mode': 'standard'
+            }
+        )
+        s3 = boto3.client('s3', config=config)
+    return s3
+
 
 def minifigure_search_request(search_str: str):
     logging.info("[s3client] Initializing Minifigure Search Request for keyword: {}".format(search_str))
     result_dict = list()
-    config = Config(
-        retries={
-            'max_attempts': 0,
-            'mode': 'standard'
-        }
-    )
     try:
-        s3 = boto3.client('s3', config=config)
-
-        response = s3.get_object(Bucket=BUCKET, Key=MINIFIGURE_FILE_NAME)
-        reader = csv.DictReader(io.StringIO(response['Body'].read().decode('utf-8')))
-        search_words = search_str.split(' ')
-        for row in reader:
-            if all(word.lower() in row["name"].lower() for word in search_words):
-                result_dict.append({
-                                        'num': row['code'],
-                                        'name': row['name'],
-                                        'year': row['year']
-                                    })
-
-        s3.close()
+        result_dict = get_minifigure_index().search(search_str)
         logging.info("[s3client] Search for \"" + search_str + '" successful with number of results: ' + str(len(result_dict)))
     except Exception as e:
         logging.error("[s3client] Error reading CSV from AWS S3")
@@ -47,17 +57,79 @@ def minifigure_search_request(search_str: str):
     return result_dict
 
 
-def write_minifigs_to_file(data_dict):
-    # creating a file buffer
-    file_buff = io.StringIO()
-    # writing csv data to file buffer
-    fig_writer = csv.writer(file_buff, dialect='excel')
-    fig_writer.writerow(['code', 'name', 'year'])
-    for code, item in data_dict.items():
-        fig_writer.writerow([code, item['name'].replace(LEFT_BRACKET, '(').replace(RIGHT_BRACKET, ')'), item['year']])
+def get_minifigure_index(refresh=False) -> BaseMinifigureIndex:
+    global minifigure_index, minifigure_key, minifigure_etag, minifigure_checked_at
+    now = time.monotonic()
+    if minifigure_index is not None and not refresh and now - minifigure_checked_at < MF_INDEX_REFRESH_INTERVAL:
+        return minifigure_index
+    # The compiled artifact is preferred; the CSV is the fallback for catalogs uploaded before it existed
+    for key, loader in ((MINIFIGURE_INDEX_FILE_NAME, CompactMinifigureIndex.from_artifact),
+                        (MINIFIGURE_FILE_NAME, MinifigureIndex.from_csv)):
+        # A conditional GET costs one round trip and no body while the catalog is unchanged
+        params = {'Bucket': BUCKET, 'Key': key}
+        if minifigure_index is not None and minifigure_key == key and minifigure_etag:
+            params['IfNoneMatch'] = minifigure_etag
+        try:
+            with tracing.span('s3', key) as call:
+                response = get_client().get_object(**params)
+                call.bytes = response.get('ContentLength')
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                logging.debug("[s3client] Minifigure catalog not modified")
+                minifigure_checked_at = now
+                return minifigure_index
+            if code == 'NoSuchKey':
+                logging.info("[s3client] No " + key + " in bucket")
+                continue
+            raise
+        try:
+            index = loader(response['Body'].read())
+        except IndexFormatError as e:
+            logging.error("[s3client] Can not load " + key)
+            logging.error(e)
+            continue
+        logging.info("[s3client] Loaded " + key + " with ETag " + response['ETag'] + ", "
+                     + str(len(index)) + " minifigures")
+        minifigure_index = index
+        minifigure_key = key
+        minifigure_etag = response['ETag']
+        minifigure_checked_at = now
+        return minifigure_index
+    raise Exception("Minifigure catalog not found in " + BUCKET)
+
+
+def normalize_name(name: str) -> str:
+    return name.replace(LEFT_BRACKET, '(').replace(RIGHT_BRACKET, ')')
 
-    # creating s3 client connection
-    client = boto3.client('s3')
-    # placing file to S3, file_buff.getvalue() is the CSV body for the file
-    client.put_object(Body=file_buff.getvalue(), Bucket=BUCKET, Key=MINIFIGURE_FILE_NAME)
 
+def write_minifigs_to_file(rows) -> int:
+    global minifigure_checked_at
+    index = MinifigureIndex()
+    seen = set()
+    # rows are spooled to disk past CSV_SPOOL_SIZE instead of building the whole CSV in memory
+    with tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE) as file_buff:
+        text_buff = io.TextIOWrapper(file_buff, encoding='utf-8', newline='')
+        fig_writer = csv.writer(text_buff, dialect='excel')
+        fig_writer.writerow(['code', 'name', 'year'])
+        for code, name, year in rows:
+            if code in seen:
+                logging.warning("[s3client] Skipping duplicate minifigure " + code)
+                continue
+            seen.add(code)
+            name = normalize_name(name)
+            fig_writer.writerow([code, name, year])
+            index.add(code, name, year)
+        text_buff.flush()
+        text_buff.detach()
+        file_buff.seek(0)
+        # upload_fileobj streams the file to S3, switching to a multipart upload for large catalogs
+        get_client().upload_fileobj(file_buff, BUCKET, MINIFIGURE_FILE_NAME)
+    index.finalize()
+    # readers load the compiled index next to the CSV instead of re-parsing and re-tokenizing it
+    get_client().put_object(Body=index.to_artifact(), Bucket=BUCKET, Key=MINIFIGURE_INDEX_FILE_NAME,
+                            ContentType='application/octet-stream',
+                            Metadata={'index-version': str(ARTIFACT_VERSION)})
+    # the next search in this container picks up the new catalog instead of waiting for the refresh interval
+    minifigure_checked_at = 0.0
+    return len(index)
@@ -0,0 +1,146 @@
+import csv
+import gzip
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import httpx
+from botocore.exceptions import ClientError
+
+import tracing
+from item_patterns import SET_EXPR
+from minifigure_index import tokenize
+from s3_client import BUCKET, get_client
+
+REBRICKABLE_SETS_URL = os.environ.get('REBRICKABLE_SETS_URL', 'https://cdn.rebrickable.com/media/downloads/sets.csv.gz')
+SETS_DB_FILE = os.environ.get('SETS_DB_FILE', 'sets.sqlite')
+SETS_DB_PATH = os.environ.get('SETS_DB_PATH', os.path.join(tempfile.gettempdir(), 'sets.sqlite'))
+SETS_DB_REFRESH_INTERVAL = int(os.environ.get('SETS_DB_REFRESH_INTERVAL', '3600'))
+SEARCH_LIMIT = 20
+
+SCHEMA = """
+CREATE TABLE sets (rowid INTEGER PRIMARY KEY, set_num TEXT NOT NULL, name TEXT NOT NULL, year INTEGER,
+                   theme_id INTEGER, num_parts INTEGER, img_url TEXT);
+CREATE VIRTUAL TABLE sets_fts USING fts5(name, set_num, content='sets', content_rowid='rowid', prefix='2 3');
+"""
+SEARCH_QUERY = """
+SELECT sets.set_num, sets.name, sets.year, sets.theme_id, sets.num_parts, sets.img_url
+FROM sets_fts JOIN sets ON sets.rowid = sets_fts.rowid
+WHERE sets_fts MATCH ?
+ORDER BY sets.year DESC
+LIMIT ?
+"""
+
+connection = None
+connection_etag = None
+connection_checked_at = 0.0
+connection_lock = threading.Lock()
+
+
+def read_sets_csv(stream):
+    for row in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+        yield (row['set_num'], row['name'], int(row['year'] or 0), int(row['theme_id'] or 0),
+               int(row['num_parts'] or 0), row.get('img_url'))
+
+
+def build_database(rows, db_path) -> int:
+    import sqlite3
+    build_path = db_path + '.build'
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    database = sqlite3.connect(build_path)
+    try:
+        database.executescript(SCHEMA)
+        database.executemany("INSERT INTO sets (set_num, name, year, theme_id, num_parts, img_url) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        database.execute("INSERT INTO sets_fts (sets_fts) VALUES ('rebuild')")
+        database.execute("INSERT INTO sets_fts (sets_fts) VALUES ('optimize')")
+        count = database.execute("SELECT count(*) FROM sets").fetchone()[0]
+        database.commit()
+    finally:
+        database.close()
+    os.replace(build_path, db_path)
+    return count
+
+
+def import_sets_csv(csv_path, db_path) -> int:
+    opener = gzip.open if csv_path.endswith('.gz') else open
+    with opener(csv_path, 'rb') as stream:
+        count = build_database(read_sets_csv(stream), db_path)
+    logging.info("[SetCatalog] Imported " + str(count) + " sets into " + db_path)
+    return count
+
+
+def refresh_handler(event, context):
+    # Scheduled job: mirror Rebrickable's bulk sets dump into the bucket for the bot containers
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'sets.csv.gz')
+        db_path = os.path.join(directory, 'sets.sqlite')
+        with httpx.stream('GET', REBRICKABLE_SETS_URL, timeout=60, follow_redirects=True) as response:
+            response.raise_for_status()
+            with open(csv_path, 'wb') as file:
+                for chunk in response.iter_bytes():
+                    file.write(chunk)
+        count = import_sets_csv(csv_path, db_path)
+        get_client().upload_file(db_path, BUCKET, SETS_DB_FILE)
+    logging.info("[SetCatalog] Published " + SETS_DB_FILE + " with " + str(count) + " sets")
+    return {"statusCode": 200, "body": str(count)}
+
+
+def get_connection():
+    global connection, connection_etag, connection_checked_at
+    with connection_lock:
+        now = time.monotonic()
+        if connection is not None and now - connection_checked_at < SETS_DB_REFRESH_INTERVAL:
+            return connection
+        connection_checked_at = now
+        params = {'Bucket': BUCKET, 'Key': SETS_DB_FILE}
+        if connection is not None and connection_etag:
+            params['IfNoneMatch'] = connection_etag
+        try:
+            with tracing.span('s3', SETS_DB_FILE) as call:
+                response = get_client().get_object(**params)
+                call.bytes = response.get('ContentLength')
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code in ('304', 'NotModified'):
+                return connection
+            if code == 'NoSuchKey':
+                logging.info("[SetCatalog] No local set catalog published yet")
+                return connection
+            raise
+        import sqlite3
+        download_path = SETS_DB_PATH + '.download'
+        with open(download_path, 'wb') as file:
+            for chunk in response['Body'].iter_chunks():
+                file.write(chunk)
+        if connection is not None:
+            connection.close()
+        os.replace(download_path, SETS_DB_PATH)
+        connection = sqlite3.connect('file:' + SETS_DB_PATH + '?mode=ro', uri=True, check_same_thread=False)
+        connection_etag = response['ETag']
+        logging.info("[SetCatalog] Loaded set catalog with ETag " + connection_etag)
+        return connection
+
+
+def search_sets(search_str: str, limit=SEARCH_LIMIT):
+    words = tokenize(search_str)
+    database = get_connection()
+    if database is None or not words:
+        return None
+    match = " ".join('"' + word + '"*' for word in words)
+    with connection_lock:
+        rows = database.execute(SEARCH_QUERY, (match, limit * 5)).fetchall()
+    results = [{
+        'set_num': set_num,
+        'name': name,
+        'year': year,
+        'theme_id': theme_id,
+        'num_parts': num_parts,
+        'set_img_url': img_url
+    } for set_num, name, year, theme_id, num_parts, img_url in rows if re.search(SET_EXPR, set_num)]
+    return {"results": results[:limit]}
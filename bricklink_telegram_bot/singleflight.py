@@ -0,0 +1,34 @@
+import asyncio
+from urllib.parse import urlencode
+
+
+def request_key(method, url, params=None) -> str:
+    key = method.upper() + " " + url
+    if params:
+        key += "?" + urlencode(sorted((str(k), str(v)) for k, v in params.items()))
+    return key
+
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def do(self, key, factory):
+        # Concurrent callers with the same key await one upstream call instead of making their own
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.calls[key] = future
+            future.add_done_callback(lambda done: self.forget(key, done))
+        else:
+            self.shared += 1
+        # shielded so one caller giving up does not cancel the call for everybody else
+        return await asyncio.shield(future)
+
+    def forget(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            # mark the exception as retrieved even if every caller was cancelled meanwhile
+            future.exception()
@@ -0,0 +1,157 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import time
+
+from telegram.request import HTTPXRequest
+
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() == 'true'
+TRACING_NAMESPACE = os.environ.get('TRACING_NAMESPACE', 'BricklinkerPy')
+# Lambda ships stdout to CloudWatch Logs, which turns Embedded Metric Format lines into metrics;
+# anywhere else a readable line is more useful
+TRACING_FORMAT = os.environ.get('TRACING_FORMAT', 'emf' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else 'text')
+OK = 'ok'
+
+current_span = contextvars.ContextVar('current_span', default=None)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Span:
+    __slots__ = ('kind', 'name', 'status', 'bytes', 'cache', 'parent', 'started', 'token')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.status = OK
+        self.bytes = None
+        self.cache = None
+        self.parent = current_span.get()
+        self.started = None
+        self.token = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        duration = (time.perf_counter() - self.started) * 1000
+        current_span.reset(self.token)
+        if exc is not None and self.status == OK:
+            self.status = error_status(exc)
+        try:
+            emit(self, duration)
+        except Exception as e:
+            logging.error("[Tracing] Failed to emit span " + self.kind + " " + self.name)
+            logging.error(e)
+        return False
+
+    def label(self) -> str:
+        return self.kind + ":" + self.name
+
+
+class NullSpan:
+    # Shared by every call site while tracing is off; attributes written to it are never read
+    def __init__(self):
+        self.status = OK
+        self.bytes = None
+        self.cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(kind, name):
+    if not TRACING_ENABLED:
+        return NULL_SPAN
+    return Span(kind, name)
+
+
+def trace(trace_id, name):
+    # Root span of one invocation; spans opened inside it carry its id
+    if not TRACING_ENABLED:
+        return NULL_SPAN
+    current_trace.set(str(trace_id))
+    return Span('update', name)
+
+
+def traced(kind, name=None):
+    def decorate(function):
+        if not TRACING_ENABLED:
+            return function
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with Span(kind, span_name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def error_status(error) -> str:
+    # botocore errors carry the S3 error code, which says more than the exception class
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and 'Error' in response:
+        return str(response['Error'].get('Code'))
+    return type(error).__name__
+
+
+def emit(finished: Span, duration):
+    if TRACING_FORMAT == 'emf':
+        line = json.dumps(emf_record(finished, duration), separators=(',', ':'))
+    else:
+        line = "[Trace] " + str(current_trace.get()) + " " + finished.label() + " " + finished.status + " " + \
+               "{:.1f}ms".format(duration)
+        if finished.bytes is not None:
+            line += " " + str(finished.bytes) + "B"
+        if finished.cache is not None:
+            line += " " + finished.cache
+        if finished.parent is not None:
+            line += " in " + finished.parent.label()
+    sys.stdout.write(line + "\n")
+
+
+def emf_record(finished: Span, duration) -> dict:
+    metrics = [{"Name": "Duration", "Unit": "Milliseconds"}]
+    dimensions = [["Kind"], ["Kind", "Name"]]
+    record = {
+        "Kind": finished.kind,
+        "Name": finished.name,
+        "Status": finished.status,
+        "Duration": round(duration, 3),
+        "TraceId": current_trace.get()
+    }
+    if finished.bytes is not None:
+        metrics.append({"Name": "Bytes", "Unit": "Bytes"})
+        record["Bytes"] = finished.bytes
+    if finished.cache is not None:
+        dimensions.append(["Kind", "Name", "Cache"])
+        record["Cache"] = finished.cache
+    if finished.parent is not None:
+        record["Parent"] = finished.parent.label()
+    record["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{"Namespace": TRACING_NAMESPACE, "Dimensions": dimensions, "Metrics": metrics}]
+    }
+    return record
+
+
+class TracedRequest(HTTPXRequest):
+    # Bot API calls, one span per method
+    async def do_request(self, url, method, *args, **kwargs):
+        with Span('telegram', url.rsplit('/', 1)[-1]) as telegram_span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            if code != 200:
+                telegram_span.status = str(code)
+            telegram_span.bytes = len(payload)
+            return code, payload
@@ -0,0 +1,245 @@
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import secrets
+import time
+
+from botocore.exceptions import ClientError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest
+
+from cache import PRICE_GUIDE_TTL
+from callbacks import encode, ITEM_TYPE_NAMES
+from catalog_ingest import iter_xml_items, CatalogFormatError
+from quota import QuotaExceeded, BACKGROUND
+from request_matcher import cached_get
+from response_formatters import get_currency_symbol
+from s3_client import BUCKET, get_client
+
+VALUATION_PREFIX = os.environ.get('VALUATION_PREFIX', 'valuations/')
+VALUATION_MAX_LOTS = int(os.environ.get('VALUATION_MAX_LOTS', '5000'))
+VALUATION_CONCURRENCY = int(os.environ.get('VALUATION_CONCURRENCY', '5'))
+VALUATION_GUIDE_TYPE = os.environ.get('VALUATION_GUIDE_TYPE', 'sold')
+VALUATION_CURRENCY = os.environ.get('VALUATION_CURRENCY', 'EUR')
+# Time a webhook invocation may spend pricing before it saves the job and hands over
+VALUATION_TIME_BUDGET = float(os.environ.get('VALUATION_TIME_BUDGET', '1.5'))
+VALUATION_PROGRESS_INTERVAL = float(os.environ.get('VALUATION_PROGRESS_INTERVAL', '3'))
+# Optional long-running worker function; without it jobs advance one Continue press at a time
+VALUATION_FUNCTION = os.environ.get('VALUATION_FUNCTION')
+VALUATION_SAFETY_MARGIN = float(os.environ.get('VALUATION_SAFETY_MARGIN', '10'))
+
+LOT_FIELDS = ('ITEMTYPE', 'ITEMID')
+OPTIONAL_LOT_FIELDS = ('COLOR', 'CONDITION', 'MINQTY', 'QTY')
+REPORT_HEADER = ('Type', 'Item', 'Color', 'Condition', 'Qty', 'Avg price', 'Min price', 'Max price', 'Lot value',
+                 'Currency')
+
+lambda_client = None
+
+
+class ValuationJob:
+    def __init__(self, job_id, chat_id, file_name, lots, prices=None, message_id=None):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.file_name = file_name
+        # lots are [item type, item number, color id, condition, quantity]
+        self.lots = lots
+        # price guide summaries keyed by lot_key, None for items without price data
+        self.prices = prices if prices is not None else {}
+        self.message_id = message_id
+        self.reported_at = 0.0
+
+    def keys(self) -> list:
+        return list(dict.fromkeys(lot_key(lot) for lot in self.lots))
+
+    def pending(self) -> list:
+        return [key for key in self.keys() if key not in self.prices]
+
+    def progress_text(self) -> str:
+        total = len(self.keys())
+        return "Valuing " + self.file_name + ": " + str(total - len(self.pending())) + " of " + str(total) + \
+               " items priced."
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.job_id,
+            'chat_id': self.chat_id,
+            'message_id': self.message_id,
+            'file_name': self.file_name,
+            'lots': self.lots,
+            'prices': self.prices
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['chat_id'], data['file_name'], data['lots'], data['prices'], data['message_id'])
+
+
+def lot_key(lot) -> str:
+    item_type, item_number, color, condition, quantity = lot
+    return item_type + '|' + item_number + '|' + color + '|' + condition
+
+
+def read_lots(stream) -> list:
+    lots = []
+    for line_number, fields in iter_xml_items(stream, LOT_FIELDS, OPTIONAL_LOT_FIELDS):
+        item_type = ITEM_TYPE_NAMES.get(fields['ITEMTYPE'].strip().upper())
+        if item_type is None:
+            raise CatalogFormatError("Line " + str(line_number) + ": unknown ITEMTYPE " + fields['ITEMTYPE'])
+        condition = 'U' if (fields['CONDITION'] or '').strip().upper() == 'U' else 'N'
+        quantity = (fields['QTY'] or fields['MINQTY'] or '1').strip()
+        lots.append([item_type, fields['ITEMID'].strip(), (fields['COLOR'] or '').strip(), condition,
+                     int(quantity) if quantity.isdigit() and int(quantity) > 0 else 1])
+        if len(lots) > VALUATION_MAX_LOTS:
+            raise CatalogFormatError("Lists are limited to " + str(VALUATION_MAX_LOTS) + " lots")
+    return lots
+
+
+def create_job(path, chat_id, file_name) -> ValuationJob:
+    with open(path, 'rb') as stream:
+        lots = read_lots(stream)
+    return ValuationJob(secrets.token_hex(8), chat_id, file_name, lots)
+
+
+def object_key(job_id) -> str:
+    return VALUATION_PREFIX + job_id + '.json'
+
+
+def save_job(job: ValuationJob):
+    get_client().put_object(Bucket=BUCKET, Key=object_key(job.job_id), Body=json.dumps(job.to_dict()).encode('utf-8'),
+                            ContentType='application/json')
+
+
+def load_job(job_id):
+    try:
+        response = get_client().get_object(Bucket=BUCKET, Key=object_key(job_id))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return None
+    return ValuationJob.from_dict(json.loads(response['Body'].read()))
+
+
+def delete_job(job_id):
+    get_client().delete_object(Bucket=BUCKET, Key=object_key(job_id))
+
+
+def start_worker(job_id):
+    global lambda_client
+    if lambda_client is None:
+        import boto3
+        lambda_client = boto3.client('lambda')
+    lambda_client.invoke(FunctionName=VALUATION_FUNCTION, InvocationType='Event',
+                         Payload=json.dumps({'job_id': job_id}).encode('utf-8'))
+
+
+async def price_item(key):
+    item_type, item_number, color, condition = key.split('|')
+    params = {
+        "guide_type": VALUATION_GUIDE_TYPE,
+        "new_or_used": condition,
+        "currency_code": VALUATION_CURRENCY
+    }
+    if color:
+        params["color_id"] = color
+    response = await cached_get(url="items/" + item_type + "/" + item_number + "/price", params=params,
+                                ttl=PRICE_GUIDE_TTL, priority=BACKGROUND)
+    if not response or "avg_price" not in response:
+        return None
+    return [response["avg_price"], response["min_price"], response["max_price"], response["currency_code"]]
+
+
+async def run_job(job: ValuationJob, bot, deadline) -> str:
+    # Prices the pending items chunk by chunk until done, out of time or out of BrickLink quota
+    pending = job.pending()
+    for start in range(0, len(pending), VALUATION_CONCURRENCY):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return 'timeout'
+        chunk = pending[start:start + VALUATION_CONCURRENCY]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(price_item(key) for key in chunk),
+                                                            return_exceptions=True), remaining)
+        except asyncio.TimeoutError:
+            return 'timeout'
+        exhausted = False
+        for key, result in zip(chunk, results):
+            if isinstance(result, QuotaExceeded):
+                exhausted = True
+            elif isinstance(result, Exception):
+                logging.error("[Valuation] Price lookup failed for " + key)
+                logging.error(result)
+                job.prices[key] = None
+            else:
+                job.prices[key] = result
+        if exhausted:
+            return 'quota'
+        await report_progress(job, bot)
+    return 'done'
+
+
+async def report_progress(job: ValuationJob, bot, text=None, reply_markup=None, force=False):
+    # Telegram throttles message edits, so progress is only rewritten every few seconds
+    if not force and time.monotonic() - job.reported_at < VALUATION_PROGRESS_INTERVAL:
+        return
+    job.reported_at = time.monotonic()
+    try:
+        await bot.edit_message_text(chat_id=job.chat_id, message_id=job.message_id,
+                                    text=text or job.progress_text(), reply_markup=reply_markup)
+    except BadRequest as e:
+        logging.debug("[Valuation] Progress not updated: " + str(e))
+
+
+def build_report(job: ValuationJob) -> tuple:
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(REPORT_HEADER)
+    total = 0.0
+    unpriced = 0
+    currency = VALUATION_CURRENCY
+    for lot in job.lots:
+        item_type, item_number, color, condition, quantity = lot
+        price = job.prices.get(lot_key(lot))
+        if price is None:
+            unpriced += 1
+            writer.writerow((item_type, item_number, color, condition, quantity, '', '', '', '', ''))
+            continue
+        avg_price, min_price, max_price, currency = price
+        value = float(avg_price) * quantity
+        total += value
+        writer.writerow((item_type, item_number, color, condition, quantity, avg_price, min_price, max_price,
+                         "{:.2f}".format(value), currency))
+    summary = "Total value of " + str(len(job.lots)) + " lots: " + get_currency_symbol(currency) + \
+              "{:.2f}".format(total)
+    if unpriced:
+        summary = summary + " (" + str(unpriced) + " lots without price data)"
+    return output.getvalue().encode('utf-8'), summary
+
+
+async def send_report(job: ValuationJob, bot):
+    report, summary = build_report(job)
+    file_name = os.path.splitext(job.file_name)[0] + "-valuation.csv"
+    await bot.send_document(chat_id=job.chat_id, document=InputFile(io.BytesIO(report), filename=file_name),
+                            caption=summary)
+    await report_progress(job, bot, text=summary, force=True)
+
+
+async def advance_job(job: ValuationJob, bot, deadline, worker=False):
+    status = await run_job(job, bot, deadline)
+    logging.info("[Valuation] Job " + job.job_id + " stopped: " + status + ", " + str(len(job.pending())) + " left")
+    if status == 'done':
+        await send_report(job, bot)
+        await asyncio.to_thread(delete_job, job.job_id)
+        return
+    await asyncio.to_thread(save_job, job)
+    if status == 'timeout' and VALUATION_FUNCTION:
+        await asyncio.to_thread(start_worker, job.job_id)
+        await report_progress(job, bot, force=not worker)
+        return
+    text = job.progress_text()
+    if status == 'quota':
+        text = text + " BrickLink request limit reached, try to continue later."
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Continue", callback_data=encode("VALUATION", job.job_id))]])
+    await report_progress(job, bot, text=text, reply_markup=reply_markup, force=True)
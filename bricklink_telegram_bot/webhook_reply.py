@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from telegram.error import NetworkError
+from telegram.request import BaseRequest
+
+# Telegram accepts one Bot API call in the body of the webhook response, which saves the round trip of making it.
+# Its result is never seen, so only calls marked with as_webhook_reply, whose result the handler ignores, are held
+# back, and only ones without file uploads.
+WEBHOOK_REPLY_ENABLED = os.environ.get('WEBHOOK_REPLY_ENABLED', 'true').lower() == 'true'
+DEFERRABLE_METHODS = ('sendMessage', 'editMessageText')
+# may reach Telegram after the reply without the user noticing, so they do not push a held back reply out
+UNORDERED_METHODS = ('answerCallbackQuery', 'sendChatAction')
+
+current_reply = ContextVar('webhook_reply', default=None)
+reply_call = ContextVar('webhook_reply_call', default=False)
+
+
+class WebhookReply:
+    def __init__(self):
+        self.request = None
+        self.url = None
+        self.request_data = None
+
+    def hold(self, request, url, request_data):
+        self.request = request
+        self.url = url
+        self.request_data = request_data
+
+    async def send(self):
+        # makes the held back call after all, e.g. because another call has to reach the chat after it
+        if self.request_data is None:
+            return
+        request, url, request_data = self.request, self.url, self.request_data
+        self.request = self.url = self.request_data = None
+        code, payload = await request.do_request(url=url, method='POST', request_data=request_data)
+        if code == 200:
+            return
+        message = "[WebhookReply] " + url.rsplit('/', 1)[-1] + " failed with " + str(code) + ": " \
+            + payload.decode('utf-8', 'replace')
+        if code == 429 or code >= 500:
+            # fails the update like a send through PTB would, so it is retried
+            raise NetworkError(message)
+        logging.error(message)
+
+    def body(self):
+        if self.request_data is None:
+            return None
+        return dict(self.request_data.parameters, method=self.url.rsplit('/', 1)[-1])
+
+
+@contextmanager
+def collect():
+    reply = WebhookReply()
+    token = current_reply.set(reply)
+    try:
+        yield reply
+    finally:
+        current_reply.reset(token)
+
+
+async def as_webhook_reply(coroutine):
+    token = reply_call.set(True)
+    try:
+        return await coroutine
+    finally:
+        reply_call.reset(token)
+
+
+class WebhookReplyRequest(BaseRequest):
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        reply = current_reply.get()
+        endpoint = url.rsplit('/', 1)[-1]
+        if reply is None or endpoint in UNORDERED_METHODS:
+            return await self.request.do_request(url, method, request_data, **kwargs)
+        # whatever was held back so far has to arrive before this call
+        await reply.send()
+        if not reply_call.get() or endpoint not in DEFERRABLE_METHODS or request_data is None \
+                or request_data.contains_files:
+            return await self.request.do_request(url, method, request_data, **kwargs)
+        logging.debug("[WebhookReply] Holding back " + endpoint + " for the webhook response")
+        reply.hold(self.request, url, request_data)
+        return 200, placeholder(endpoint, request_data.parameters)
+
+
+def placeholder(endpoint, parameters) -> bytes:
+    # stands in for the result Telegram would have returned; as_webhook_reply callers do not look at it
+    if endpoint == 'editMessageText':
+        result = True
+    else:
+        result = {"message_id": 0, "date": int(time.time()), "chat": {"id": parameters.get('chat_id'), "type": "private"}}
+    return json.dumps({"ok": True, "result": result}).encode('utf-8')